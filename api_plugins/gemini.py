@@ -1,5 +1,8 @@
 import requests
 import logging
+import time
+
+import lexi_http
 
 PLUGIN_NAME = "Gemini"
 default_host = "https://generativelanguage.googleapis.com"
@@ -12,7 +15,7 @@ def is_host_available(host, api_key=None):
         response = requests.get(url, timeout=5)
         return response.status_code == 200
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error checking host availability: {e}")
+        logging.error("Error checking host availability: %s", e)
         return False
 
 
@@ -28,12 +31,43 @@ def get_available_models(host, api_key=None):
             if model_name:
                 models.append(model_name.split("/")[-1])
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching models: {e}")
+        logging.error("Error fetching models: %s", e)
     return models
 
 
-def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120):
-    url = f"{host}/v1beta/models/{model}:generateContent?key={api_key}"
+def get_model_capabilities(host, model, api_key=None):
+    url = f"{host}/v1beta/models/{model}?key={api_key}"
+    response = lexi_http.session.get(url, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    return {"context_length": data.get("inputTokenLimit"), "max_output_tokens": data.get("outputTokenLimit")}
+
+
+def get_embeddings(host, model, api_key, texts, api_request_timeout=120):
+    url = f"{host}/v1beta/models/{model}:batchEmbedContents?key={api_key}"
+    headers = {"Content-Type": "application/json"}
+    data = {
+        "requests": [
+            {
+                "model": f"models/{model}",
+                "content": {"parts": [{"text": text}]}
+            }
+            for text in texts
+        ]
+    }
+    try:
+        response = lexi_http.session.post(url, headers=headers, json=data,
+                                          timeout=lexi_http.get_timeout(api_request_timeout))
+        response.raise_for_status()
+        return [embedding["values"] for embedding in lexi_http.json_loads(response.content)["embeddings"]]
+    except requests.exceptions.RequestException as e:
+        logging.error("Error fetching embeddings: %s", e)
+        raise
+
+
+def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120, cancel_token=None,
+                     max_tokens=None, context_length=None):
+    url = f"{host}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
     headers = {"Content-Type": "application/json"}
     data = {
         "contents": [
@@ -46,14 +80,30 @@ def send_api_request(host, model, api_key, messages, system_prompt=None, api_req
             }
         ]
     }
+    if max_tokens:
+        data["generationConfig"] = {"maxOutputTokens": max_tokens}
     try:
-        if api_request_timeout == 0:
-            response = requests.post(url, headers=headers, json=data)
-        else:
-            response = requests.post(url, headers=headers, json=data, timeout=api_request_timeout)
-        response.raise_for_status()
-        response_json = response.json()
-        return response_json["candidates"][0]["content"]["parts"][0]["text"]
+        lines = lexi_http.stream_lines(url, headers=headers, data=data,
+                                       api_request_timeout=api_request_timeout, cancel_token=cancel_token)
+        started = time.monotonic()
+        first_token = None
+        parts = []
+        usage = {}
+        for chunk in lexi_http.iter_sse_data(lines):
+            if "error" in chunk:
+                raise RuntimeError(f"{PLUGIN_NAME} error: {chunk['error']}")
+            for candidate in chunk.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    if first_token is None:
+                        first_token = time.monotonic() - started
+                    parts.append(part.get("text", ""))
+            usage = chunk.get("usageMetadata") or usage
+        return {
+            "text": "".join(parts),
+            "prompt_tokens": usage.get("promptTokenCount"),
+            "completion_tokens": usage.get("candidatesTokenCount"),
+            "timings": {"first_token": first_token, "total": time.monotonic() - started}
+        }
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during API request: {e}")
+        logging.error("Error during API request: %s", e)
         raise
\ No newline at end of file
@@ -1,5 +1,10 @@
 import requests
 import logging
+import threading
+import time
+import uuid
+
+import lexi_http
 
 PLUGIN_NAME = "KoboldCpp"
 default_host = "http://localhost:1551"
@@ -11,7 +16,7 @@ def is_host_available(host, api_key=None):
         response = requests.get(url, timeout=5)
         return response.status_code == 200
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error checking host availability: {e}")
+        logging.error("Error checking host availability: %s", e)
         return False
 
 
@@ -23,16 +28,41 @@ def get_available_models(host, api_key=None):
         data = response.json()
         return data.get("result")
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching models: {e}")
+        logging.error("Error fetching models: %s", e)
         return []
 
 
-def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120):
+def get_model_capabilities(host, model, api_key=None):
+    # true_max_context_length reports the launch --contextsize even when a
+    # client has requested less; older servers only have the config endpoint.
+    for path in ("/api/extra/true_max_context_length", "/api/v1/config/max_context_length"):
+        response = lexi_http.session.get(f"{host}{path}", timeout=10)
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        return {"context_length": response.json().get("value"), "max_output_tokens": None}
+    return {"context_length": None, "max_output_tokens": None}
+
+
+def warm_up(host, model, api_key=None, keep_alive=None, context_length=None):
+    # KoboldCpp loads its model at launch; a one-token generation makes sure the
+    # backend buffers are allocated before the first real request.
     url = f"{host}/api/v1/generate"
+    data = {"prompt": "Hi", "max_length": 1, "max_context_length": 64}
+    response = lexi_http.session.post(url, json=data, timeout=300)
+    response.raise_for_status()
+
+
+def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120, cancel_token=None,
+                     max_tokens=None, context_length=None):
+    url = f"{host}/api/extra/generate/stream"
     headers = {"Content-Type": "application/json"}
+    genkey = f"KCPP{uuid.uuid4().hex[:8]}"
     data = {
+        "genkey": genkey,
         "prompt": f"{system_prompt}\n{messages}",
-        "max_context_length": 2048,
+        "max_context_length": context_length or 2048,
+        "max_length": max_tokens or 512,
         "temperature": 0.7,
         "top_p": 0.92,
         "top_k": 100,
@@ -50,14 +80,41 @@ def send_api_request(host, model, api_key, messages, system_prompt=None, api_req
         "length_penalty": 1,
         "stopping_strings": []
     }
+
+    def send_abort():
+        try:
+            lexi_http.session.post(f"{host}/api/extra/abort", json={"genkey": genkey}, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logging.error("Error aborting generation: %s", e)
+
+    def abort_generation():
+        # Dropping the stream is not enough for KoboldCpp, it keeps generating
+        # until told to stop. The abort is sent in the background so the thread
+        # that cancels, usually a message handler, does not wait for it.
+        threading.Thread(target=send_abort, name="koboldcpp-abort", daemon=True).start()
+
+    if cancel_token:
+        cancel_token.add_callback(abort_generation)
     try:
-        if api_request_timeout == 0:
-            response = requests.post(url, headers=headers, json=data)
-        else:
-            response = requests.post(url, headers=headers, json=data, timeout=api_request_timeout)
-        response.raise_for_status()
-        response_json = response.json()
-        return response_json["results"][0]["text"]
+        lines = lexi_http.stream_lines(url, headers=headers, data=data,
+                                       api_request_timeout=api_request_timeout, cancel_token=cancel_token)
+        started = time.monotonic()
+        first_token = None
+        parts = []
+        for chunk in lexi_http.iter_sse_data(lines):
+            if first_token is None:
+                first_token = time.monotonic() - started
+            parts.append(chunk.get("token", ""))
+        # The stream does not report token usage; Lexi falls back to counting locally.
+        return {
+            "text": "".join(parts),
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "timings": {"first_token": first_token, "total": time.monotonic() - started}
+        }
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during API request: {e}")
-        raise
\ No newline at end of file
+        logging.error("Error during API request: %s", e)
+        raise
+    finally:
+        if cancel_token:
+            cancel_token.remove_callback(abort_generation)
\ No newline at end of file
@@ -1,5 +1,8 @@
 import requests
 import logging
+import time
+
+import lexi_http
 
 PLUGIN_NAME = "Ollama"
 default_host = "http://localhost:11434"
@@ -11,7 +14,7 @@ def is_host_available(host, api_key=None):
         response = requests.get(url, timeout=5)
         return response.status_code == 200
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error checking host availability: {e}")
+        logging.error("Error checking host availability: %s", e)
         return False
 
 
@@ -24,11 +27,76 @@ def get_available_models(host, api_key=None):
         data = response.json()
         models = [model.get("name") for model in data.get("models", [])]
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching models: {e}")
+        logging.error("Error fetching models: %s", e)
     return models
 
 
-def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120):
+def get_model_capabilities(host, model, api_key=None):
+    url = f"{host}/api/show"
+    headers = {"Authorization": f"Bearer {api_key}" if api_key else ""}
+    response = lexi_http.session.post(url, headers=headers, json={"model": model}, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    # A num_ctx baked into the Modelfile wins over what the architecture supports.
+    for line in data.get("parameters", "").splitlines():
+        name, _, value = line.partition(" ")
+        if name == "num_ctx" and value.strip().isdigit():
+            return {"context_length": int(value.strip()), "max_output_tokens": None}
+    # Otherwise only the architecture maximum is known, which is far more than
+    # Ollama allocates by default and may not fit in memory.
+    model_info = data.get("model_info", {})
+    architecture = model_info.get("general.architecture")
+    return {"context_length": model_info.get(f"{architecture}.context_length"), "max_output_tokens": None,
+            "architecture_limit": True}
+
+
+def warm_up(host, model, api_key=None, keep_alive=None, context_length=None):
+    # A generate request without a prompt only loads the model into memory.
+    # keep_alive controls how long Ollama keeps it loaded after this request,
+    # and num_ctx has to match later requests or they reload the runner.
+    url = f"{host}/api/generate"
+    headers = {"Authorization": f"Bearer {api_key}" if api_key else ""}
+    data = {"model": model}
+    if keep_alive is not None:
+        data["keep_alive"] = keep_alive
+    if context_length:
+        data["options"] = {"num_ctx": context_length}
+    response = lexi_http.session.post(url, headers=headers, json=data, timeout=300)
+    response.raise_for_status()
+
+
+def get_embeddings(host, model, api_key, texts, api_request_timeout=120):
+    url = f"{host}/api/embed"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}" if api_key else ""
+    }
+    data = {
+        "model": model,
+        "input": texts
+    }
+    try:
+        response = lexi_http.session.post(url, headers=headers, json=data,
+                                          timeout=lexi_http.get_timeout(api_request_timeout))
+        if response.status_code == 404:
+            # Servers older than /api/embed only embed one prompt per call.
+            return [get_legacy_embedding(host, model, headers, text, api_request_timeout) for text in texts]
+        response.raise_for_status()
+        return lexi_http.json_loads(response.content)["embeddings"]
+    except requests.exceptions.RequestException as e:
+        logging.error("Error fetching embeddings: %s", e)
+        raise
+
+
+def get_legacy_embedding(host, model, headers, text, api_request_timeout):
+    response = lexi_http.session.post(f"{host}/api/embeddings", headers=headers, json={"model": model, "prompt": text},
+                                      timeout=lexi_http.get_timeout(api_request_timeout))
+    response.raise_for_status()
+    return lexi_http.json_loads(response.content)["embedding"]
+
+
+def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120, cancel_token=None,
+                     max_tokens=None, context_length=None):
     url = f"{host}/api/chat"
     headers = {
         "Content-Type": "application/json",
@@ -37,16 +105,44 @@ def send_api_request(host, model, api_key, messages, system_prompt=None, api_req
     data = {
         "model": model,
         "messages": messages,
-        "stream": False
+        "stream": True
     }
+    options = {}
+    if max_tokens:
+        options["num_predict"] = max_tokens
+    if context_length:
+        options["num_ctx"] = context_length
+    if options:
+        data["options"] = options
     try:
-        if api_request_timeout == 0:
-            response = requests.post(url, headers=headers, json=data)
-        else:
-            response = requests.post(url, headers=headers, json=data, timeout=api_request_timeout)
-        response.raise_for_status()
-        response_json = response.json()
-        return response_json["message"]["content"]
+        lines = lexi_http.stream_lines(url, headers=headers, data=data,
+                                       api_request_timeout=api_request_timeout, cancel_token=cancel_token)
+        started = time.monotonic()
+        first_token = None
+        parts = []
+        final = {}
+        for chunk in lexi_http.iter_json_lines(lines):
+            if "error" in chunk:
+                raise RuntimeError(f"{PLUGIN_NAME} error: {chunk['error']}")
+            content = chunk.get("message", {}).get("content", "")
+            if content and first_token is None:
+                first_token = time.monotonic() - started
+            parts.append(content)
+            if chunk.get("done"):
+                final = chunk
+                break
+        return {
+            "text": "".join(parts),
+            "prompt_tokens": final.get("prompt_eval_count"),
+            "completion_tokens": final.get("eval_count"),
+            "timings": {
+                "first_token": first_token,
+                "total": time.monotonic() - started,
+                "load": final.get("load_duration", 0) / 1e9,
+                "prompt_eval": final.get("prompt_eval_duration", 0) / 1e9,
+                "eval": final.get("eval_duration", 0) / 1e9
+            }
+        }
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during API request: {e}")
+        logging.error("Error during API request: %s", e)
         raise
\ No newline at end of file
@@ -1,5 +1,8 @@
 import requests
 import logging
+import time
+
+import lexi_http
 
 PLUGIN_NAME = "OpenAI"
 default_host = "https://api.openai.com"
@@ -14,7 +17,7 @@ def is_host_available(host, api_key=None):
         response = requests.get(url, headers=headers, timeout=5)
         return response.status_code == 200
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error checking host availability: {e}")
+        logging.error("Error checking host availability: %s", e)
         return False
 
 
@@ -30,28 +33,82 @@ def get_available_models(host, api_key=None):
         data = response.json()
         models = [model.get("id") for model in data.get("data", [])]
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching models: {e}")
+        logging.error("Error fetching models: %s", e)
     return models
 
 
-def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120):
-    url = f"{host}/v1/chat/completions"
+def get_model_capabilities(host, model, api_key=None):
+    # OpenAI itself does not report token limits; OpenAI-compatible servers
+    # such as vLLM add max_model_len to the model object.
+    url = f"{host}/v1/models/{model}"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    response = lexi_http.session.get(url, headers=headers, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    return {"context_length": data.get("context_length") or data.get("max_model_len"), "max_output_tokens": None}
+
+
+def get_embeddings(host, model, api_key, texts, api_request_timeout=120):
+    url = f"{host}/v1/embeddings"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
     }
     data = {
         "model": model,
-        "messages": messages
+        "input": texts
     }
     try:
-        if api_request_timeout == 0:
-            response = requests.post(url, headers=headers, json=data)
-        else:
-            response = requests.post(url, headers=headers, json=data, timeout=api_request_timeout)
+        response = lexi_http.session.post(url, headers=headers, json=data,
+                                          timeout=lexi_http.get_timeout(api_request_timeout))
         response.raise_for_status()
-        response_json = response.json()
-        return response_json["choices"][0]["message"]["content"]
+        items = sorted(lexi_http.json_loads(response.content)["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in items]
+    except requests.exceptions.RequestException as e:
+        logging.error("Error fetching embeddings: %s", e)
+        raise
+
+
+def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120, cancel_token=None,
+                     max_tokens=None, context_length=None):
+    url = f"{host}/v1/chat/completions"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    data = {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    try:
+        lines = lexi_http.stream_lines(url, headers=headers, data=data,
+                                       api_request_timeout=api_request_timeout, cancel_token=cancel_token)
+        started = time.monotonic()
+        first_token = None
+        parts = []
+        usage = {}
+        for chunk in lexi_http.iter_sse_data(lines):
+            if "error" in chunk:
+                raise RuntimeError(f"{PLUGIN_NAME} error: {chunk['error']}")
+            for choice in chunk.get("choices", []):
+                content = choice.get("delta", {}).get("content")
+                if content:
+                    if first_token is None:
+                        first_token = time.monotonic() - started
+                    parts.append(content)
+            usage = chunk.get("usage") or usage
+        return {
+            "text": "".join(parts),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "timings": {"first_token": first_token, "total": time.monotonic() - started}
+        }
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during API request: {e}")
+        logging.error("Error during API request: %s", e)
         raise
\ No newline at end of file
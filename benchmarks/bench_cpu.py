@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import threading
+import time
+
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lexi_cpu
+import lexi_http
+
+
+def random_text(rng, length):
+    words = ("".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(length // 6 + 1))
+    return " ".join(words)[:length]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_load(encoding, args, workers):
+    lexi_cpu.configure({"workers": workers})
+    rng = random.Random(0)
+    long_turns = [random_text(rng, args.turn_chars) for _ in range(args.turns)]
+    short_messages = [random_text(rng, 200) for _ in range(64)]
+    stop = threading.Event()
+    latencies = []
+    long_counts = [0]
+
+    def long_chat(seed):
+        # Every request re-counts a long context, as happens after a model
+        # change or when an idle, compressed chat becomes active again.
+        local = random.Random(seed)
+        while not stop.is_set():
+            texts = local.sample(long_turns, min(len(long_turns), args.context_turns))
+            lexi_cpu.count_texts(encoding, texts)
+            long_counts[0] += 1
+
+    def handler():
+        # A handler thread's own work on a short message: a token count and a
+        # small JSON decode.
+        local = random.Random()
+        while not stop.is_set():
+            started = time.perf_counter()
+            lexi_cpu.count_texts(encoding, [local.choice(short_messages)])
+            lexi_http.json_loads('{"message": {"content": "hello"}, "done": false}')
+            latencies.append(time.perf_counter() - started)
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=long_chat, args=(index,), daemon=True) for index in range(args.long_chats)]
+    threads += [threading.Thread(target=handler, daemon=True) for _ in range(args.handlers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    label = f"{workers} workers" if workers else "inline"
+    print(f"{label:>10}: handler p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms; "
+          f"{long_counts[0] / args.seconds:.1f} long contexts counted/s")
+
+
+def run_json(args):
+    payload = json.dumps({"embeddings": [[random.random() for _ in range(768)] for _ in range(args.embeddings)]})
+    for name, loads in (("json", json.loads), ("json_loads", lexi_http.json_loads)):
+        started = time.perf_counter()
+        for _ in range(5):
+            loads(payload)
+        elapsed = (time.perf_counter() - started) / 5
+        print(f"{name:>10}: {elapsed * 1000:.1f} ms to decode {len(payload) / 2 ** 20:.1f} MiB of embeddings")
+    print(f"orjson {'installed' if lexi_http.orjson else 'not installed'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handler-thread latency with and without CPU offload.")
+    parser.add_argument("--encoding", default="cl100k_base")
+    parser.add_argument("--workers", type=int, default=2, help="CPU offload workers to compare against inline")
+    parser.add_argument("--long-chats", type=int, default=4, help="threads re-counting long contexts")
+    parser.add_argument("--handlers", type=int, default=4, help="threads handling short messages")
+    parser.add_argument("--turns", type=int, default=500, help="distinct long turns to sample from")
+    parser.add_argument("--turn-chars", type=int, default=2000)
+    parser.add_argument("--context-turns", type=int, default=100, help="turns per long context")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--embeddings", type=int, default=256, help="vectors in the JSON decode test")
+    args = parser.parse_args()
+
+    encoding = tiktoken.get_encoding(args.encoding)
+    print(f"{args.long_chats} long chats ({args.context_turns} turns of {args.turn_chars} chars), "
+          f"{args.handlers} handler threads, {os.cpu_count()} CPUs")
+    run_load(encoding, args, 0)
+    run_load(encoding, args, args.workers)
+    run_json(args)
+
+
+if __name__ == "__main__":
+    main()
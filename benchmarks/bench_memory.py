@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lexi_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the long-term memory vector index.")
+    parser.add_argument("--turns", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--batch", type=int, default=32, help="Turns embedded per incremental update")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.turns, args.dim), dtype=np.float32)
+    texts = [f"user: turn {i}" for i in range(args.turns)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = lexi_memory.VectorIndex(os.path.join(directory, "chat"))
+
+        started = time.perf_counter()
+        for offset in range(0, args.turns, args.batch):
+            index.add(vectors[offset:offset + args.batch], texts[offset:offset + args.batch])
+        elapsed = time.perf_counter() - started
+        print(f"add:    {args.turns} turns in {elapsed:.2f}s ({args.turns / elapsed:,.0f} turns/s, batch {args.batch})")
+
+        query_ids = rng.integers(0, args.turns, args.queries)
+        queries = vectors[query_ids]
+        started = time.perf_counter()
+        for query in queries:
+            index.search(query, args.top_k)
+        elapsed = time.perf_counter() - started
+        print(f"search: {elapsed / args.queries * 1000:.2f} ms/query (one at a time)")
+
+        started = time.perf_counter()
+        results = index.search(queries, args.top_k)
+        elapsed = time.perf_counter() - started
+        print(f"search: {elapsed / args.queries * 1000:.2f} ms/query (batched, {args.queries} queries)")
+        hits = sum(result[0][1] == texts[query_id] for result, query_id in zip(results, query_ids))
+        print(f"recall: {hits}/{args.queries} queries found their own turn first")
+
+        started = time.perf_counter()
+        reloaded = lexi_memory.VectorIndex(os.path.join(directory, "chat"))
+        elapsed = time.perf_counter() - started
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"load:   {len(reloaded)} turns in {elapsed:.2f}s ({size / 2 ** 20:.1f} MiB on disk)")
+        print(f"memory: {index.vectors.nbytes / 2 ** 20:.1f} MiB of vectors in RAM")
+
+
+if __name__ == "__main__":
+    main()
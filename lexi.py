@@ -1,25 +1,50 @@
+import io
 import json
 import logging
 import os
+import signal
 import time
 import threading
 import tiktoken
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 import telebot
 from telebot import types
 from telebot.apihelper import ApiTelegramException
 
+import lexi_admission
 import lexi_ai_api
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-# logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-BOT_TOKEN = os.environ.get("BOT_TOKEN")
-BOT_USERNAME = os.environ.get("BOT_USERNAME")
-ADMIN_USER_ID = int(os.environ.get("ADMIN_USER_ID"))
-
-CONFIG_DATA_FILE = "config.json"
-USER_DATA_FILE = "users.json"
+import lexi_bench
+import lexi_cpu
+import lexi_deadlines
+import lexi_documents
+import lexi_history
+import lexi_logging
+import lexi_memory
+import lexi_recorder
+import lexi_router
+import lexi_tenants
+import lexi_trace
+
+lexi_logging.setup()
+# Set LEXI_LOG_LEVEL=DEBUG for verbose logs, LEXI_LOG_FORMAT=json for structured output.
+
+TENANT = lexi_tenants.current()
+TENANT_NAME = TENANT["name"]
+BOT_TOKEN = TENANT["bot_token"]
+lexi_logging.redact(BOT_TOKEN)
+BOT_USERNAME = TENANT["bot_username"]
+ADMIN_USER_ID = int(TENANT["admin_user_id"])
+
+CONFIG_DATA_FILE = os.path.join(TENANT["data_dir"], "config.json")
+USER_DATA_FILE = os.path.join(TENANT["data_dir"], "users.json")
+MEMORY_DIR = os.path.join(TENANT["data_dir"], "memory")
+USAGE_DATA_FILE = os.path.join(TENANT["data_dir"], "usage.json")
+BENCH_DATA_FILE = os.path.join(TENANT["data_dir"], "bench.json")
+DEADLINES_DATA_FILE = os.path.join(TENANT["data_dir"], "deadlines.json")
+BENCH_HISTORY_LIMIT = 20
 
 GROUP_MODES = {
     "respond_to_mentions_only": "Respond only to mentions",
@@ -33,12 +58,29 @@ PARSE_MODES = {
     "None": "None"
 }
 
+CANCEL_POLICIES = {
+    "newer_message": "Cancel on the same user's newer message or /clearcontext",
+    "clear_context": "Cancel only on /clearcontext",
+    "never": "Never cancel"
+}
+
+DEFAULT_CONTEXT_TOKENS = 2048
+
+BUSY_MESSAGE = "I'm handling too many requests right now. Please try again in a moment."
+
 bot = telebot.TeleBot(BOT_TOKEN)
 
 allowed_users = {}
 config = {}
 chat_contexts = {}
 typing_active = {}
+bot_id = None
+inflight_requests = {}
+group_threads = {}
+message_threads = {}
+threads_lock = threading.Lock()
+pending_turns = {}
+pending_turns_lock = threading.Lock()
 global_host = None
 global_model = None
 global_api_type = None
@@ -48,15 +90,40 @@ global_system_prompt = None
 global_parse_mode = "Markdown"
 api_request_timeout = 120
 group_mode = "respond_to_mentions_only"
-max_context_tokens = 2048
+max_context_tokens = 0
+auto_context_tokens = 4096
+max_response_tokens = 1024
+cancel_policy = "newer_message"
+coalesce_window_ms = 1000
+history_settings = {"compress_idle_seconds": 900, "keep_recent_turns": 4}
+memory_settings = {"enabled": False, "embedding_model": None, "top_k": 3, "min_score": 0.35}
+thread_settings = {"max_threads": 0, "max_tracked_messages": 2000}
+document_settings = {"enabled": True, "max_file_bytes": 2 * 1024 * 1024, "max_chat_bytes": 4 * 1024 * 1024,
+                     "chunk_tokens": 400, "max_excerpt_tokens": 1500}
+document_store = lexi_documents.DocumentStore(document_settings["max_chat_bytes"])
+warmup_settings = {"enabled": True, "keep_warm_hours": [], "keep_warm_interval": 240, "keep_alive": "10m"}
+memory_store = lexi_memory.MemoryStore(MEMORY_DIR)
+memory_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lexi-memory")
+encodings = {}
+system_prompt_tokens = {}
+warmup_lock = threading.Lock()
+last_backend_activity = 0
+usage_stats = {"chats": {}, "users": {}, "calibration": {}}
+usage_lock = threading.Lock()
+usage_dirty = False
+bench_lock = threading.Lock()
+config_lock = threading.RLock()
 
 
 def load_data():
     global allowed_users, config, global_host, global_model, global_api_type, \
-        global_api_key, global_allow_all_users, global_system_prompt, group_mode, global_parse_mode, max_context_tokens
+        global_api_key, global_allow_all_users, global_system_prompt, group_mode, global_parse_mode, max_context_tokens, \
+        cancel_policy, coalesce_window_ms, history_settings, memory_settings, max_response_tokens, usage_stats, \
+        warmup_settings, thread_settings, document_settings, api_request_timeout, \
+        auto_context_tokens
 
     allowed_users = load_json_data(USER_DATA_FILE, default={str(ADMIN_USER_ID): ADMIN_USER_ID})
-    logging.info(f"Loaded allowed users: {allowed_users}")
+    logging.info("Loaded allowed users: %s", allowed_users)
 
     config = load_json_data(CONFIG_DATA_FILE, default={
         "api_type": None,
@@ -67,21 +134,39 @@ def load_data():
         "system_prompt": None,
         "group_mode": "respond_to_mentions_only",
         "parse_mode": "Markdown",
-        "max_context_tokens": 2048
+        "max_context_tokens": 0,
+        "auto_context_tokens": 4096,
+        "max_response_tokens": 1024,
+        "api_request_timeout": 120,
+        "cancel_policy": "newer_message",
+        "coalesce_window_ms": 1000,
+        "history": {"compress_idle_seconds": 900, "keep_recent_turns": 4},
+        "memory": {"enabled": False, "embedding_model": None, "top_k": 3, "min_score": 0.35},
+        "thread_contexts": {"max_threads": 0, "max_tracked_messages": 2000},
+        "documents": {"enabled": True, "max_file_bytes": 2 * 1024 * 1024, "max_chat_bytes": 4 * 1024 * 1024,
+                      "chunk_tokens": 400, "max_excerpt_tokens": 1500},
+        "warmup": {"enabled": True, "keep_warm_hours": [], "keep_warm_interval": 240, "keep_alive": "10m"},
+        "admission": dict(lexi_admission.DEFAULT_SETTINGS),
+        "routing": dict(lexi_router.DEFAULT_SETTINGS),
+        "cpu_offload": dict(lexi_cpu.DEFAULT_SETTINGS),
+        "deadlines": dict(lexi_deadlines.DEFAULT_SETTINGS)
     })
-    logging.info(f"Loaded config: {config}")
+    logging.info("Loaded config: %s", config)
 
     global_api_type = config.get("api_type")
     global_host = config.get("host")
     global_model = config.get("model")
     global_api_key = config.get("api_key")
     global_parse_mode = config.get("parse_mode", "Markdown")
-    max_context_tokens = config.get("max_context_tokens", 2048)
+    max_context_tokens = config.get("max_context_tokens", 0)
+    auto_context_tokens = config.get("auto_context_tokens", 4096)
+    max_response_tokens = config.get("max_response_tokens", 1024)
+    api_request_timeout = config.get("api_request_timeout", 120)
 
     if global_api_type and global_host and global_model:
         logging.info(
-            f"Using API: {global_api_type}, Host: {global_host}, Model: {global_model}, "
-            f"API Key: {'***' if global_api_key else None}"
+            "Using API: %s, Host: %s, Model: %s, API Key: %s",
+            global_api_type, global_host, global_model, '***' if global_api_key else None
         )
     else:
         logging.warning("API configuration incomplete.")
@@ -89,29 +174,57 @@ def load_data():
     global_allow_all_users = config.get("allow_all_users", False)
     global_system_prompt = config.get("system_prompt")
     group_mode = config.get("group_mode", "respond_to_mentions_only")
+    cancel_policy = config.get("cancel_policy", "newer_message")
+    coalesce_window_ms = config.get("coalesce_window_ms", 1000)
+    history_settings = {"compress_idle_seconds": 900, "keep_recent_turns": 4, **config.get("history", {})}
+    memory_settings = {"enabled": False, "embedding_model": None, "top_k": 3, "min_score": 0.35,
+                       **config.get("memory", {})}
+    warmup_settings = {"enabled": True, "keep_warm_hours": [], "keep_warm_interval": 240, "keep_alive": "10m",
+                       **config.get("warmup", {})}
+    thread_settings = {"max_threads": 0, "max_tracked_messages": 2000, **config.get("thread_contexts", {})}
+    document_settings = {"enabled": True, "max_file_bytes": 2 * 1024 * 1024, "max_chat_bytes": 4 * 1024 * 1024,
+                         "chunk_tokens": 400, "max_excerpt_tokens": 1500, **config.get("documents", {})}
+    document_store.max_bytes_per_chat = document_settings["max_chat_bytes"]
     logging.info(
-        f"Allow all users: {global_allow_all_users}, System prompt: {global_system_prompt}, "
-        f"Group Mode: {group_mode}, Parse Mode: {global_parse_mode}, Max context tokens: {max_context_tokens}"
+        "Allow all users: %s, System prompt: %s, Group Mode: %s, Parse Mode: %s, Max context tokens: %s, "
+        "Max response tokens: %s, Cancel policy: %s, Coalesce window: %s ms, API request timeout: %s",
+        global_allow_all_users, global_system_prompt, group_mode, global_parse_mode, max_context_tokens or 'auto',
+        max_response_tokens, cancel_policy, coalesce_window_ms, api_request_timeout or 'none'
     )
 
+    if TENANT_NAME is None:
+        lexi_admission.configure(config.get("admission"))
+        lexi_router.configure(config.get("routing"))
+        lexi_cpu.configure(config.get("cpu_offload"))
+        lexi_deadlines.configure(config.get("deadlines"))
+    else:
+        # The queue, workers, routing, CPU offload and deadlines are shared and
+        # configured by the tenant host.
+        lexi_admission.configure(config.get("admission"), tenant=TENANT_NAME)
+
+    usage_stats = {"chats": {}, "users": {}, "calibration": {},
+                   **load_json_data(USAGE_DATA_FILE, default={})}
+    if TENANT_NAME is None:
+        lexi_deadlines.load(load_json_data(DEADLINES_DATA_FILE, default={}))
+
 
 def load_json_data(file_path, default=None):
     try:
         with open(file_path, "r", encoding='utf-8') as f:
             return json.load(f)
     except FileNotFoundError:
-        logging.warning(f"No {file_path} file found. Using default values.")
+        logging.warning("No %s file found. Using default values.", file_path)
         return default
 
 
 def save_data(file_path, data):
     with open(file_path, "w", encoding='utf-8') as f:
         json.dump(data, f, indent=4)
-    logging.info(f"Saved data to {file_path}")
+    logging.info("Saved data to %s", file_path)
 
 
 def send_typing_action(chat_id, bot, typing_active):
-    logging.info(f"Sending typing action to chat {chat_id}...")
+    logging.info("Sending typing action to chat %s...", chat_id)
     while typing_active.get(chat_id, False):
         try:
             bot.send_chat_action(chat_id, 'typing')
@@ -119,15 +232,15 @@ def send_typing_action(chat_id, bot, typing_active):
         except telebot.apihelper.ApiTelegramException as e:
             if e.error_code == 429:
                 retry_after = int(e.description.split("after ")[-1])
-                logging.warning(f"Rate limited. Retrying after {retry_after} seconds.")
+                logging.warning("Rate limited. Retrying after %s seconds.", retry_after)
                 time.sleep(retry_after)
             else:
-                logging.error(f"Telegram API Error: {e}")
+                logging.error("Telegram API Error: %s", e)
                 break
 
 
 def check_config(chat_id):
-    logging.info(f"Checking config for chat {chat_id}...")
+    logging.info("Checking config for chat %s...", chat_id)
     if not global_api_type or not global_host or not global_model:
         bot.send_message(chat_id, "API configuration is incomplete. Use /setup command.")
         logging.warning("API configuration incomplete.")
@@ -136,29 +249,124 @@ def check_config(chat_id):
     plugin = lexi_ai_api.SUPPORTED_API_TYPES.get(global_api_type)
     if plugin and getattr(plugin, "api_key_required", False) and not global_api_key:
         bot.send_message(chat_id, f"API key is required for {global_api_type}. Use /setup command.")
-        logging.warning(f"API key required but not provided for {global_api_type}.")
+        logging.warning("API key required but not provided for %s.", global_api_type)
         return False
 
     logging.info("Configuration is valid.")
     return True
 
 
+def get_encoding(model: str):
+    encoding = encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            logging.warning("Warning: model not found. Using cl100k_base encoding.")
+            encoding = tiktoken.get_encoding("cl100k_base")
+        encodings[model] = encoding
+    return encoding
+
+
 def count_tokens(messages, model: str) -> int:
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logging.warning(f"Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    texts = []
     num_tokens = 0
     for message in messages:
         num_tokens += 4
         for key, value in message.items():
             if value is not None:
-                num_tokens += len(encoding.encode(value))
+                texts.append(value)
             if key == "name":
                 num_tokens -= 1
     num_tokens += 3
-    return num_tokens
+    return num_tokens + sum(lexi_cpu.count_texts(get_encoding(model), texts))
+
+
+def count_turns_tokens(turns, model: str):
+    return count_encoded_turns(turns, get_encoding(model))
+
+
+def count_encoded_turns(turns, encoding):
+    texts = [text for role, content in turns for text in (role, content or "")]
+    counts = lexi_cpu.count_texts(encoding, texts)
+    return [4 + counts[index] + counts[index + 1] for index in range(0, len(counts), 2)]
+
+
+def count_history_tokens(history, encoding):
+    # Cached per encoding rather than per model: most models share one, so
+    # switching between them does not re-tokenize the whole history.
+    return history.count_tokens(encoding.name, lambda turns: count_encoded_turns(turns, encoding))
+
+
+def count_turn_tokens(role, content, model: str) -> int:
+    return count_turns_tokens([(role, content)], model)[0]
+
+
+def get_system_prompt_tokens(system_prompt, model):
+    key = (model, system_prompt)
+    tokens = system_prompt_tokens.get(key)
+    if tokens is None:
+        tokens = system_prompt_tokens[key] = count_turn_tokens("system", system_prompt, model)
+    return tokens
+
+
+def count_extra_tokens(extra_messages, system_prompt, model):
+    # The system prompt is identical for every request, so its count is cached
+    # (and pre-computed during warm-up); only recalled memories are encoded.
+    if not system_prompt:
+        return count_tokens(extra_messages, model)
+    return count_tokens(extra_messages[1:], model) + get_system_prompt_tokens(system_prompt, model)
+
+
+def estimate_prompt_tokens(history, local_tokens, model):
+    # Anchor on the exact count the server reported for the previous request and
+    # only add the (calibrated) local count of what changed since then. Another
+    # model's count says nothing about this one's tokenizer, so it is dropped.
+    factor = usage_stats["calibration"].get(model, 1.0)
+    if history.prompt_model != model:
+        history.server_prompt_tokens = history.local_prompt_tokens = None
+    if history.server_prompt_tokens is not None and history.local_prompt_tokens is not None:
+        return history.server_prompt_tokens + round((local_tokens - history.local_prompt_tokens) * factor)
+    return round(local_tokens * factor)
+
+
+def record_token_usage(chat_id, user_id, model, history, local_tokens, response):
+    global usage_dirty
+    prompt_tokens = response.get("prompt_tokens")
+    completion_tokens = response.get("completion_tokens")
+    if completion_tokens is None:
+        completion_tokens = count_turn_tokens("assistant", response["text"], model) - 4
+
+    with usage_lock:
+        if prompt_tokens:
+            history.prompt_model = model
+            history.server_prompt_tokens = prompt_tokens
+            history.local_prompt_tokens = local_tokens
+            ratio = min(max(prompt_tokens / max(local_tokens, 1), 0.5), 3.0)
+            factor = usage_stats["calibration"].get(model)
+            usage_stats["calibration"][model] = ratio if factor is None else factor * 0.8 + ratio * 0.2
+        else:
+            prompt_tokens = estimate_prompt_tokens(history, local_tokens, model)
+
+        for scope, key in (("chats", str(chat_id)), ("users", str(user_id))):
+            entry = usage_stats[scope].setdefault(key, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            entry["requests"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+        usage_dirty = True
+
+    logging.info("Chat %s used %s prompt and %s completion tokens.", chat_id, prompt_tokens, completion_tokens)
+    return prompt_tokens, completion_tokens
+
+
+def save_usage_stats():
+    global usage_dirty
+    with usage_lock:
+        if not usage_dirty:
+            return
+        usage_dirty = False
+        snapshot = json.loads(json.dumps(usage_stats))
+    save_data(USAGE_DATA_FILE, snapshot)
 
 
 def send_api_request(
@@ -173,7 +381,11 @@ def send_api_request(
         bot=None,
         typing_active=None,
         api_request_timeout=120,
-        max_context_tokens=2048
+        max_context_tokens=0,
+        user_id=None,
+        cancel_token=None,
+        chat_type=None,
+        context_key=None
 ):
     global chat_contexts
 
@@ -182,54 +394,421 @@ def send_api_request(
     typing_thread.start()
 
     try:
-        while count_tokens(chat_contexts[chat_id], model) > max_context_tokens:
-            logging.warning(f"Context for chat {chat_id} exceeds token limit. Removing oldest messages...")
-            chat_contexts[chat_id].pop(1)
-
-        if chat_contexts[chat_id][0]["role"] == "system" and chat_contexts[chat_id][0]["content"] is None:
-            chat_contexts[chat_id] = chat_contexts[chat_id][1:]
-
-        response_text = lexi_ai_api.send_api_request(
-            api_type=api_type,
-            host=host,
-            model=model,
-            api_key=api_key,
-            messages=chat_contexts[chat_id],
-            system_prompt=system_prompt,
-            api_request_timeout=api_request_timeout
-        )
-
+        if context_key is None:
+            context_key = chat_id
+        history = chat_contexts[context_key]
+        # Memories get at most a quarter of the prompt budget and excerpts the
+        # rest of its first half, so the conversation still fits a small window.
+        context_budget, _ = get_token_limits(api_type, host, model, api_key, max_context_tokens)
+        with lexi_trace.span("memory"):
+            memories = recall_memories(chat_id, history.last_content(), api_type, host, api_key)
+            memories, memory_tokens = fit_memories(memories, context_budget // 4, model)
+        excerpts = []
+        if document_store.has_documents(context_key):
+            with lexi_trace.span("documents"):
+                excerpt_tokens = min(document_settings["max_excerpt_tokens"], context_budget // 2 - memory_tokens)
+                excerpts = document_store.select_excerpts(context_key, history.last_content(), excerpt_tokens)
+        extra_messages = build_extra_messages(system_prompt, memories, excerpts)
+
+        targets = [{"name": lexi_router.DEFAULT_TARGET, "api_type": api_type, "host": host, "model": model,
+                    "api_key": api_key}]
+        if lexi_router.is_enabled():
+            with lexi_trace.span("route"):
+                # Any encoding is close enough to pick a target, so reuse the
+                # one the history is already counted in.
+                encoding = tiktoken.get_encoding(history.token_encoding) if history.token_encoding \
+                    else get_encoding(model)
+                context_tokens = count_history_tokens(history, encoding)
+                targets = lexi_router.route(
+                    targets[0],
+                    message_chars=len(history.last_content() or ""),
+                    context_tokens=context_tokens,
+                    chat_type=chat_type,
+                    user_id=user_id
+                )
+
+        # Falling back to another target does not restart the clock: every
+        # attempt shares the request's deadline.
+        request_deadline = lexi_ai_api.Deadline(api_request_timeout)
+        evicted_turns = []
+        for index, target in enumerate(targets):
+            target_api_type, target_model = target["api_type"], target["model"]
+            with lexi_trace.span("limits"):
+                context_budget, response_tokens = get_token_limits(
+                    target_api_type, target["host"], target_model, target.get("api_key"), max_context_tokens
+                )
+
+            with lexi_trace.span("trim"):
+                local_tokens = count_extra_tokens(extra_messages, system_prompt, target_model) + \
+                    count_history_tokens(history, get_encoding(target_model))
+                prompt_tokens = estimate_prompt_tokens(history, local_tokens, target_model)
+                trimmed_turns = []
+                while prompt_tokens > context_budget and len(history) > 1:
+                    logging.warning("Context for chat %s exceeds token limit. Removing oldest messages...", chat_id)
+                    turn = history.pop_oldest()
+                    trimmed_turns.append(turn)
+                    local_tokens -= turn["tokens"]
+                    prompt_tokens = estimate_prompt_tokens(history, local_tokens, target_model)
+                messages = extra_messages + history.to_messages()
+            if trimmed_turns:
+                # Remembered before the request, so the turns are not lost if every target fails.
+                remember_turns(chat_id, trimmed_turns, api_type, host, api_key)
+                evicted_turns.extend(trimmed_turns)
+
+            backend_started = time.monotonic()
+            try:
+                response = lexi_ai_api.send_api_request(
+                    api_type=target_api_type,
+                    host=target["host"],
+                    model=target_model,
+                    api_key=target.get("api_key"),
+                    messages=messages,
+                    system_prompt=system_prompt,
+                    api_request_timeout=request_deadline,
+                    cancel_token=cancel_token,
+                    max_tokens=response_tokens,
+                    context_length=context_budget + response_tokens
+                )
+            except lexi_ai_api.RequestCancelled:
+                raise
+            except Exception as e:
+                backend_latency = time.monotonic() - backend_started
+                lexi_recorder.record_backend(target_api_type, target_model, backend_latency, error=e)
+                lexi_router.record_result(target["name"], backend_latency, False)
+                if index + 1 == len(targets) or request_deadline.expired:
+                    raise
+                logging.warning("Target '%s' failed for chat %s: %s. Falling back to '%s'.",
+                                target['name'], chat_id, e, targets[index + 1]['name'])
+                lexi_router.record_fallback(targets[index + 1]["name"])
+                continue
+            backend_latency = time.monotonic() - backend_started
+            lexi_recorder.record_backend(target_api_type, target_model, backend_latency, response)
+            mark_backend_activity()
+            break
+
+        model = target_model
+
+        if cancel_token and cancel_token.cancelled:
+            raise lexi_ai_api.RequestCancelled(cancel_token.reason)
+
+        timings = response.get("timings") or {}
+        lexi_trace.annotate(first_token=timings.get("first_token"), evicted=len(evicted_turns), target=target["name"])
+
+        response_text = response["text"]
         if response_text:
-            chat_contexts[chat_id].append({"role": "assistant", "content": response_text})
+            history.append("assistant", response_text)
+            prompt_tokens, completion_tokens = record_token_usage(
+                chat_id, user_id, model, history, local_tokens, response
+            )
+            lexi_router.record_result(target["name"], backend_latency, True, prompt_tokens + completion_tokens)
+            lexi_admission.record_usage(user_id, chat_id, prompt_tokens + completion_tokens, tenant=TENANT_NAME)
 
             chunks = split_into_chunks(response_text, 4096)
 
             for index, chunk in enumerate(chunks):
                 try:
-                    bot.send_message(
-                        chat_id,
-                        chunk,
-                        reply_to_message_id=reply_to_message_id if index == 0 else None,
-                        parse_mode=parse_mode
-                    )
+                    with lexi_trace.span(f"send chunk {index + 1}"):
+                        sent_message = bot.send_message(
+                            chat_id,
+                            chunk,
+                            reply_to_message_id=reply_to_message_id if index == 0 else None,
+                            parse_mode=parse_mode
+                        )
                 except ApiTelegramException:
-                    logging.warning(f"Error sending message with Markdown. Retrying without Markdown...")
-                    bot.send_message(
-                        chat_id,
-                        chunk,
-                        reply_to_message_id=reply_to_message_id if index == 0 else None
-                    )
+                    logging.warning("Error sending message with Markdown. Retrying without Markdown...")
+                    with lexi_trace.span(f"retry chunk {index + 1} without markdown"):
+                        sent_message = bot.send_message(
+                            chat_id,
+                            chunk,
+                            reply_to_message_id=reply_to_message_id if index == 0 else None
+                        )
+                if context_key != chat_id:
+                    # Replies to any part of the answer continue the same thread.
+                    track_thread_message(chat_id, sent_message.message_id, context_key)
         else:
             bot.send_message(chat_id, "Error: Empty response from API")
             logging.error("Empty response from API")
 
+    except lexi_ai_api.RequestCancelled as e:
+        logging.info("Request for chat %s was cancelled: %s", chat_id, e)
     except (TimeoutError, ConnectionError, RuntimeError) as e:
         bot.send_message(chat_id, str(e))
-        logging.error(f"Error during API request: {e}")
+        logging.error("Error during API request: %s", e)
+    except requests.exceptions.Timeout as e:
+        # Deadlines and read timeouts from the backend plugins.
+        bot.send_message(chat_id, "Error: The model did not answer in time. Please try again.")
+        logging.error("API request for chat %s timed out: %s", chat_id, e)
+    except requests.exceptions.RequestException as e:
+        bot.send_message(chat_id, "Error: Could not get a response from the model.")
+        logging.error("Error during API request: %s", e)
     finally:
         typing_active[chat_id] = False
 
 
+def get_token_limits(api_type, host, model, api_key, max_context_tokens=0):
+    capabilities = lexi_ai_api.get_model_capabilities(host, api_type, model, api_key)
+    context_length = capabilities.get("context_length")
+
+    response_tokens = max_response_tokens
+    if capabilities.get("max_output_tokens"):
+        response_tokens = min(response_tokens, capabilities["max_output_tokens"])
+
+    if max_context_tokens:
+        # /contextlimit is the prompt budget, as it always was; the response
+        # budget comes on top of it.
+        context_budget = max_context_tokens
+    else:
+        context_window = context_length or DEFAULT_CONTEXT_TOKENS
+        if capabilities.get("architecture_limit"):
+            context_window = min(context_window, auto_context_tokens)
+        response_tokens = min(response_tokens, context_window // 2)
+        context_budget = context_window - response_tokens
+    if context_length and context_budget + response_tokens > context_length:
+        # Never ask for more than the model's window. The response gives way
+        # first, down to half of it, then the prompt.
+        response_tokens = min(response_tokens, context_length // 2)
+        context_budget = context_length - response_tokens
+    return context_budget, response_tokens
+
+
+def build_extra_messages(system_prompt, memories=None, excerpts=None):
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    if memories:
+        memory_text = "Relevant parts of the earlier conversation:\n" + "\n".join(f"- {memory}" for memory in memories)
+        messages.append({"role": "system", "content": memory_text})
+    if excerpts:
+        excerpt_text = "Relevant excerpts from documents the user shared:\n\n" + "\n\n".join(
+            f"[{name}]\n{text}" for name, text in excerpts
+        )
+        messages.append({"role": "system", "content": excerpt_text})
+    return messages
+
+
+def fit_memories(memories, max_tokens, model):
+    # Keeps the best matches that fit; memories come sorted by relevance.
+    used_tokens = 0
+    for index, tokens in enumerate(count_turns_tokens([("system", memory) for memory in memories], model)):
+        if used_tokens + tokens > max_tokens:
+            return memories[:index], used_tokens
+        used_tokens += tokens
+    return memories, used_tokens
+
+
+def recall_memories(chat_id, query, api_type, host, api_key):
+    if not memory_settings["enabled"] or not memory_settings["embedding_model"] or not query:
+        return []
+    if not len(memory_store.get_index(chat_id)):
+        return []
+    try:
+        query_vector = lexi_ai_api.get_embeddings(api_type, host, memory_settings["embedding_model"], api_key,
+                                                  [query])[0]
+    except Exception as e:
+        logging.error("Error recalling memories for chat %s: %s", chat_id, e)
+        return []
+    memories = memory_store.search(chat_id, query_vector, memory_settings["top_k"], memory_settings["min_score"])
+    logging.info("Recalled %s memories for chat %s.", len(memories), chat_id)
+    return memories
+
+
+def remember_turns(chat_id, turns, api_type, host, api_key):
+    if not memory_settings["enabled"] or not memory_settings["embedding_model"]:
+        return
+    texts = [f"{turn['role']}: {turn['content']}" for turn in turns if turn and turn["content"]]
+    if texts:
+        memory_executor.submit(embed_turns, chat_id, texts, api_type, host, api_key)
+
+
+def embed_turns(chat_id, texts, api_type, host, api_key):
+    try:
+        vectors = lexi_ai_api.get_embeddings(api_type, host, memory_settings["embedding_model"], api_key, texts)
+        memory_store.add(chat_id, vectors, texts)
+        logging.info("Stored %s evicted turns in memory for chat %s.", len(texts), chat_id)
+    except Exception as e:
+        logging.error("Error storing memories for chat %s: %s", chat_id, e)
+
+
+def get_context_key(message):
+    # Groups can keep one context per reply chain or forum topic instead of one
+    # per chat. Private chats, and groups with thread contexts off, use the chat id.
+    chat_id = message.chat.id
+    if message.chat.type == 'private' or not thread_settings["max_threads"]:
+        return chat_id
+
+    with threads_lock:
+        if message.is_topic_message and message.message_thread_id:
+            context_key = (chat_id, "topic", message.message_thread_id)
+        elif message.reply_to_message:
+            reply_id = message.reply_to_message.message_id
+            context_key = message_threads.get(chat_id, {}).get(reply_id)
+            if context_key is None:
+                context_key = (chat_id, "reply", message.message_thread_id or reply_id)
+        else:
+            context_key = (chat_id, "reply", message.message_id)
+
+        threads = group_threads.setdefault(chat_id, OrderedDict())
+        threads[context_key] = True
+        threads.move_to_end(context_key)
+        while len(threads) > thread_settings["max_threads"]:
+            evicted_key, _ = threads.popitem(last=False)
+            chat_contexts.pop(evicted_key, None)
+            document_store.forget(evicted_key)
+            logging.info("Evicted least recently used thread context %s.", evicted_key)
+
+    track_thread_message(chat_id, message.message_id, context_key)
+    return context_key
+
+
+def track_thread_message(chat_id, message_id, context_key):
+    with threads_lock:
+        messages = message_threads.setdefault(chat_id, OrderedDict())
+        messages[message_id] = context_key
+        while len(messages) > thread_settings["max_tracked_messages"]:
+            messages.popitem(last=False)
+
+
+def get_chat_context_keys(chat_id):
+    return [key for key in list(chat_contexts) if key == chat_id or (isinstance(key, tuple) and key[0] == chat_id)]
+
+
+def track_request(request_key):
+    # Requests are tracked per (context, user), so a newer message only
+    # supersedes the same user's own request, not other members' in a group.
+    cancel_token = lexi_ai_api.CancelToken()
+    previous_token = inflight_requests.get(request_key)
+    inflight_requests[request_key] = cancel_token
+    return cancel_token, previous_token
+
+
+def supersede_request(previous_token):
+    if previous_token and cancel_policy == "newer_message":
+        previous_token.cancel("superseded by a newer message")
+
+
+def release_request(request_key, cancel_token, previous_token=None):
+    if inflight_requests.get(request_key) is cancel_token:
+        if previous_token and not previous_token.cancelled:
+            inflight_requests[request_key] = previous_token
+        else:
+            del inflight_requests[request_key]
+
+
+def drop_pending_turns(context_keys):
+    # Messages still being coalesced belong to the context that is going away.
+    with pending_turns_lock:
+        for turn_key in [key for key in pending_turns if key[0] in context_keys]:
+            turn = pending_turns.pop(turn_key)
+            if turn["timer"] is not None:
+                turn["timer"].cancel()
+
+
+def cancel_requests(context_key, reason):
+    for request_key in [key for key in list(inflight_requests) if key[0] == context_key]:
+        cancel_token = inflight_requests.pop(request_key, None)
+        if cancel_token:
+            cancel_token.cancel(reason)
+
+
+def mark_backend_activity():
+    global last_backend_activity
+    last_backend_activity = time.monotonic()
+
+
+def get_warm_up_targets():
+    targets = {(global_api_type, global_host, global_model): global_api_key}
+    if lexi_router.is_enabled():
+        for target in lexi_router.settings["targets"].values():
+            targets.setdefault((target["api_type"], target["host"], target["model"]), target.get("api_key"))
+    return [(api_type, host, model, api_key) for (api_type, host, model), api_key in targets.items()
+            if api_type and host and model]
+
+
+def warm_up_backend(keep_alive=None):
+    if not warmup_lock.acquire(blocking=False):
+        return
+    try:
+        for api_type, host, model, api_key in get_warm_up_targets():
+            try:
+                # Load the model with the window real requests ask for, or the
+                # first request would make the backend load it again.
+                context_budget, response_tokens = get_token_limits(api_type, host, model, api_key,
+                                                                   max_context_tokens)
+                lexi_ai_api.warm_up(host, api_type, model, api_key, keep_alive=keep_alive,
+                                    connections=lexi_admission.settings["workers"],
+                                    context_length=context_budget + response_tokens)
+                if global_system_prompt:
+                    get_system_prompt_tokens(global_system_prompt, model)
+            except Exception as e:
+                logging.error("Error warming up %s model %s: %s", api_type, model, e)
+        mark_backend_activity()
+    finally:
+        warmup_lock.release()
+
+
+def start_warm_up(keep_alive=None):
+    if not warmup_settings["enabled"]:
+        return
+    threading.Thread(target=warm_up_backend, args=(keep_alive,), name="lexi-warmup", daemon=True).start()
+
+
+def is_keep_warm_time(now=None):
+    now = now or time.localtime()
+    minutes = now.tm_hour * 60 + now.tm_min
+    for period in warmup_settings["keep_warm_hours"]:
+        start, end = (int(hours) * 60 + int(mins) for hours, mins in
+                      (value.split(":") for value in period.split("-")))
+        if start <= minutes < end or (end < start and (minutes >= start or minutes < end)):
+            return True
+    return False
+
+
+def keep_warm():
+    if not warmup_settings["enabled"] or not is_keep_warm_time():
+        return
+    if time.monotonic() - last_backend_activity < warmup_settings["keep_warm_interval"]:
+        return
+    logging.info("Backend idle during keep-warm hours. Refreshing the loaded model.")
+    start_warm_up(warmup_settings["keep_alive"])
+
+
+def save_deadlines():
+    # In multi-tenant mode the tenant host saves the shared deadlines once for all bots.
+    if TENANT_NAME is not None or not lexi_deadlines.dirty:
+        return
+    lexi_deadlines.dirty = False
+    save_data(DEADLINES_DATA_FILE, lexi_deadlines.to_json())
+
+
+def compress_idle_chats():
+    idle_seconds = history_settings["compress_idle_seconds"]
+    if not idle_seconds:
+        return
+    compressed_turns = 0
+    for chat_id, history in list(chat_contexts.items()):
+        if history.is_idle(idle_seconds):
+            compressed_turns += history.compress(history_settings["keep_recent_turns"])
+    if compressed_turns:
+        logging.info("Compressed %s turns in idle chats.", compressed_turns)
+
+
+def run_maintenance():
+    # Every step is guarded on its own, so one failing neither skips the
+    # others nor ends the thread.
+    steps = (
+        ("saving usage statistics", save_usage_stats),
+        ("saving deadlines", save_deadlines),
+        ("keeping the backend warm", keep_warm),
+        ("writing routing metrics", lexi_router.write_metrics),
+        ("compressing idle chats", compress_idle_chats)
+    )
+    while True:
+        time.sleep(60)
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                logging.error("Error %s: %s", name, e)
+
+
 def split_into_chunks(text, chunk_size):
     return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
 
@@ -239,7 +818,7 @@ def handle_start_command(message):
     global chat_contexts
     chat_id = message.chat.id
     user_id = message.from_user.id
-    logging.info(f"User {user_id} started a dialogue in chat {chat_id}")
+    logging.info("User %s started a dialogue in chat %s", user_id, chat_id)
 
     if user_id == ADMIN_USER_ID:
         start_setup_admin(chat_id)
@@ -256,13 +835,13 @@ def handle_start_command(message):
                              parse_mode=global_parse_mode)
 
     if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = [{"role": "system", "content": global_system_prompt}]
+        chat_contexts[chat_id] = lexi_history.ChatHistory()
 
 
 @bot.message_handler(commands=["help"])
 def handle_help_command(message):
     user_id = message.from_user.id
-    logging.info(f"User {user_id} requested help")
+    logging.info("User %s requested help", user_id)
     if user_id == ADMIN_USER_ID:
         help_text = """
         *Available admin commands:*
@@ -271,17 +850,26 @@ def handle_help_command(message):
         /help - Show this help message
         /myid - Show your Telegram ID
         /clearcontext - Clear context
+        /usage - Show token usage
 
         /setup - Setup the bot
         /systemprompt - Set a system prompt
         /model - Select a model
-        /timeout - Set API request timeout
+        /timeout - Show per-backend deadlines and set the API request timeout
         /adduser - Add a user
         /deluser - Delete a user
         /useraccess - Toggle access between all users and authorized users only
         /groupmode - Choose the bot's behavior in groups
         /parsemode - Choose the message parsing mode (Markdown, HTML, None)
         /contextlimit - Set the context size limit in tokens
+        /maxtokens - Set the maximum response length in tokens
+        /cancelpolicy - Choose when in-flight requests are cancelled
+        /perf - Show the slowest recent requests, or profile with /perf profile|cprofile [seconds]
+        /router - Show routing targets, their health and routing decisions
+        /bench - Measure backend latency with /bench [requests] [concurrency] [all]
+        /reload - Reload changed plugins and config.json without restarting
+        /coalesce - Set the window for merging quick consecutive messages
+        /threads - Set how many reply threads per group keep their own context
         """
     else:
         help_text = """
@@ -291,6 +879,7 @@ def handle_help_command(message):
         /help - Show this help message
         /myid - Show your Telegram ID
         /clearcontext - Clear context
+        /usage - Show your token usage
         """
     bot.reply_to(message, help_text, parse_mode='Markdown')
 
@@ -348,9 +937,20 @@ def handle_parse_mode_command(message):
 def handle_clear_context_command(message):
     global chat_contexts
     chat_id = message.chat.id
-    chat_contexts[chat_id] = [{"role": "system", "content": global_system_prompt}]
+    context_keys = get_chat_context_keys(chat_id) + [chat_id]
+    drop_pending_turns(context_keys)
+    for context_key in context_keys:
+        if cancel_policy != "never":
+            cancel_requests(context_key, "context cleared")
+        chat_contexts.pop(context_key, None)
+        document_store.forget(context_key)
+    with threads_lock:
+        group_threads.pop(chat_id, None)
+        message_threads.pop(chat_id, None)
+    chat_contexts[chat_id] = lexi_history.ChatHistory()
+    memory_store.forget(chat_id)
     bot.reply_to(message, "Context cleared ")
-    logging.info(f"Context cleared for chat {chat_id}")
+    logging.info("Context cleared for chat %s", chat_id)
 
 
 @bot.message_handler(commands=['adduser'])
@@ -406,6 +1006,68 @@ def handle_group_mode_command(message):
 
     bot.send_message(message.chat.id, "Choose group mode:", reply_markup=markup)
 
+@bot.message_handler(commands=['cancelpolicy'])
+def handle_cancel_policy_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for policy, description in CANCEL_POLICIES.items():
+        markup.add(types.InlineKeyboardButton(description, callback_data=f"set_cancel_policy_{policy}"))
+
+    bot.send_message(message.chat.id, "Choose when to cancel in-flight requests:", reply_markup=markup)
+
+@bot.message_handler(commands=['coalesce'])
+def handle_coalesce_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+
+    bot.reply_to(message, "Enter the window in milliseconds for merging consecutive messages (0 to disable):")
+    bot.register_next_step_handler(message, get_coalesce_window)
+
+def get_coalesce_window(message):
+    global coalesce_window_ms, config
+    try:
+        new_window = int(message.text)
+        if new_window >= 0:
+            coalesce_window_ms = new_window
+            config["coalesce_window_ms"] = coalesce_window_ms
+            save_data(CONFIG_DATA_FILE, config)
+            bot.reply_to(message, f"Messages sent within {coalesce_window_ms} ms will be merged.")
+        else:
+            bot.reply_to(message, "The window must be greater than or equal to zero.")
+    except ValueError:
+        bot.reply_to(message, "Invalid window. Please enter an integer.")
+
+@bot.message_handler(commands=['threads'])
+def handle_threads_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+
+    bot.reply_to(message, "Enter the maximum number of reply threads with their own context per group "
+                          "(0 to share one context per group):")
+    bot.register_next_step_handler(message, get_max_threads)
+
+def get_max_threads(message):
+    global config
+    try:
+        new_max_threads = int(message.text)
+        if new_max_threads >= 0:
+            thread_settings["max_threads"] = new_max_threads
+            config["thread_contexts"] = thread_settings
+            save_data(CONFIG_DATA_FILE, config)
+            if new_max_threads:
+                bot.reply_to(message, f"Groups will keep up to {new_max_threads} reply threads with separate contexts.")
+            else:
+                bot.reply_to(message, "Groups will share one context per chat.")
+        else:
+            bot.reply_to(message, "The number of threads must be greater than or equal to zero.")
+    except ValueError:
+        bot.reply_to(message, "Invalid number. Please enter an integer.")
+
 @bot.message_handler(commands=['contextlimit'])
 def handle_context_limit_command(message):
     global max_context_tokens, config
@@ -413,7 +1075,7 @@ def handle_context_limit_command(message):
         bot.reply_to(message, "You don't have permission to use this command.")
         return
 
-    bot.reply_to(message, "Enter the desired context size limit in tokens:")
+    bot.reply_to(message, "Enter the desired context size limit in tokens (0 to use the model's context window):")
     bot.register_next_step_handler(message, get_context_limit)
 
 def get_context_limit(message):
@@ -425,12 +1087,41 @@ def get_context_limit(message):
             config["max_context_tokens"] = max_context_tokens
             save_data(CONFIG_DATA_FILE, config)
             bot.reply_to(message, f"Context size limit set to {max_context_tokens} tokens.")
+        elif new_limit == 0:
+            max_context_tokens = 0
+            config["max_context_tokens"] = max_context_tokens
+            save_data(CONFIG_DATA_FILE, config)
+            bot.reply_to(message, "Context size limit now follows the model's context window.")
         else:
-            bot.reply_to(message, "Context size limit must be a positive integer.")
+            bot.reply_to(message, "Context size limit must be a positive integer or 0.")
     except ValueError:
         bot.reply_to(message, "Invalid context size limit. Please enter an integer.")
 
 
+@bot.message_handler(commands=['maxtokens'])
+def handle_max_tokens_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+
+    bot.reply_to(message, "Enter the maximum number of tokens per response:")
+    bot.register_next_step_handler(message, get_max_tokens)
+
+def get_max_tokens(message):
+    global max_response_tokens, config
+    try:
+        new_limit = int(message.text)
+        if new_limit > 0:
+            max_response_tokens = new_limit
+            config["max_response_tokens"] = max_response_tokens
+            save_data(CONFIG_DATA_FILE, config)
+            bot.reply_to(message, f"Responses are now limited to {max_response_tokens} tokens.")
+        else:
+            bot.reply_to(message, "Response token limit must be a positive integer.")
+    except ValueError:
+        bot.reply_to(message, "Invalid response token limit. Please enter an integer.")
+
+
 @bot.message_handler(commands=['timeout'])
 def handle_timeout_command(message):
     global api_request_timeout
@@ -438,10 +1129,164 @@ def handle_timeout_command(message):
         bot.reply_to(message, "You don't have permission to use this command.")
         return
 
-    bot.reply_to(message, "Please enter the new timeout value in seconds (0 for infinite):")
+    lines = [f"Current timeout: {api_request_timeout or 'none'}. Per-backend deadlines:"]
+    for key, entry in sorted(lexi_deadlines.get_snapshot().items()):
+        if entry["deadline"] is None:
+            lines.append(f"{key}: learning ({entry['samples']} requests observed)")
+        else:
+            lines.append(f"{key}: deadline {entry['deadline']:.0f}s, read timeout {entry['read_timeout']:.0f}s "
+                         f"({entry['samples']} requests observed)")
+    lines.append("\nPlease enter the new timeout value in seconds (0 for no limit):")
+    bot.reply_to(message, "\n".join(lines))
     bot.register_next_step_handler(message, get_timeout_value)
 
 
+@bot.message_handler(commands=['usage'])
+def handle_usage_command(message):
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    empty = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    with usage_lock:
+        user_usage = dict(usage_stats["users"].get(str(user_id), empty))
+        chat_usage = dict(usage_stats["chats"].get(str(chat_id), empty))
+        top_users = sorted(usage_stats["users"].items(),
+                           key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"], reverse=True)[:5]
+        top_chats = sorted(usage_stats["chats"].items(),
+                           key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"], reverse=True)[:5]
+
+    def describe(usage):
+        return (f"{usage['requests']} requests, {usage['prompt_tokens']} prompt tokens, "
+                f"{usage['completion_tokens']} completion tokens")
+
+    usage_text = f"Your usage: {describe(user_usage)}\nThis chat: {describe(chat_usage)}"
+    if user_id == ADMIN_USER_ID:
+        usage_text += "\n\nTop users:\n" + "\n".join(f"{key}: {describe(usage)}" for key, usage in top_users)
+        usage_text += "\n\nTop chats:\n" + "\n".join(f"{key}: {describe(usage)}" for key, usage in top_chats)
+    bot.reply_to(message, usage_text)
+
+
+@bot.message_handler(commands=['router'])
+def handle_router_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+    if not lexi_router.is_enabled():
+        bot.reply_to(message, "Routing is disabled. Configure the routing section of config.json to enable it.")
+        return
+
+    snapshot = lexi_router.get_metrics()
+    lines = ["Routing targets:"]
+    for name, entry in sorted(snapshot["targets"].items()):
+        latency = f"{entry['latency']:.2f}s" if entry["latency"] is not None else "n/a"
+        error_rate = f"{entry['error_rate']:.0%}" if entry["error_rate"] is not None else "n/a"
+        lines.append(f"{name}: {'healthy' if entry['healthy'] else 'unhealthy'}, latency {latency}, "
+                     f"errors {error_rate}, {entry['ok']} ok / {entry['errors']} failed, "
+                     f"{entry['fallbacks']} fallbacks, cost {entry['cost']:.4f}")
+    lines.append("\nDecisions:")
+    for (rule, target), count in sorted(snapshot["decisions"].items()):
+        lines.append(f"{rule} -> {target}: {count}")
+    bot.reply_to(message, "\n".join(lines))
+
+
+@bot.message_handler(commands=['bench'])
+def handle_bench_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+    if not global_api_type or not global_host:
+        bot.reply_to(message, "No backend is configured yet. Use /setup first.")
+        return
+
+    args = message.text.split()[1:]
+    all_models = "all" in args
+    numbers = [arg for arg in args if arg != "all"]
+    try:
+        requests_per_model = int(numbers[0]) if numbers else 8
+        concurrency = int(numbers[1]) if len(numbers) > 1 else 4
+    except ValueError:
+        bot.reply_to(message, "Usage: /bench [requests] [concurrency] [all]")
+        return
+    requests_per_model = min(max(requests_per_model, 1), 100)
+    concurrency = min(max(concurrency, 1), 16)
+
+    if not bench_lock.acquire(blocking=False):
+        bot.reply_to(message, "A benchmark is already running.")
+        return
+    models = "every available model" if all_models else global_model
+    bot.reply_to(message, f"Benchmarking {models} with {requests_per_model} requests, {concurrency} at a time...")
+    threading.Thread(target=send_bench_report, args=(message.chat.id, requests_per_model, concurrency, all_models),
+                     daemon=True).start()
+
+
+def send_bench_report(chat_id, requests_per_model, concurrency, all_models):
+    try:
+        models = [global_model]
+        if all_models:
+            models = lexi_ai_api.get_available_models(global_host, global_api_type, global_api_key) or models
+        run = lexi_bench.run_benchmark(
+            global_api_type, global_host, global_api_key, models,
+            requests_per_model=requests_per_model,
+            concurrency=concurrency,
+            api_request_timeout=api_request_timeout,
+            count_tokens=lambda text, model: count_turn_tokens("assistant", text, model) - 4
+        )
+        runs = load_json_data(BENCH_DATA_FILE, default=[])
+        report = lexi_bench.format_report(run, runs)
+        save_data(BENCH_DATA_FILE, (runs + [run])[-BENCH_HISTORY_LIMIT:])
+    except Exception as e:
+        logging.error("Benchmark failed: %s", e)
+        report = f"Benchmark failed: {e}"
+    finally:
+        bench_lock.release()
+    for chunk in split_into_chunks(report, 4096):
+        bot.send_message(chat_id, chunk)
+
+
+@bot.message_handler(commands=['reload'])
+def handle_reload_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+    bot.reply_to(message, reload())
+
+
+@bot.message_handler(commands=['perf'])
+def handle_perf_command(message):
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.reply_to(message, "You don't have permission to use this command.")
+        return
+
+    args = message.text.split()[1:]
+    if args and args[0] in ("profile", "cprofile"):
+        try:
+            seconds = int(args[1]) if len(args) > 1 else 30
+        except ValueError:
+            bot.reply_to(message, "Usage: /perf profile|cprofile [seconds]")
+            return
+        seconds = min(max(seconds, 1), 600)
+        bot.reply_to(message, f"Profiling for {seconds} seconds...")
+        threading.Thread(target=send_profile_report, args=(message.chat.id, args[0], seconds), daemon=True).start()
+        return
+
+    traces = lexi_trace.slowest_traces(10, tenant=TENANT_NAME)
+    if not traces:
+        bot.reply_to(message, "No requests have been traced yet.")
+        return
+    report = "Slowest recent requests:\n\n" + "\n\n".join(lexi_trace.format_trace(trace) for trace in traces)
+    for chunk in split_into_chunks(report, 4096):
+        bot.send_message(message.chat.id, chunk)
+
+
+def send_profile_report(chat_id, mode, seconds):
+    if mode == "cprofile":
+        report = lexi_trace.profile_jobs(seconds)
+    else:
+        report = lexi_trace.sample_threads(seconds)
+    document = io.BytesIO(report.encode("utf-8"))
+    document.name = f"lexi-{mode}-{int(time.time())}.txt"
+    bot.send_document(chat_id, document, caption=f"{mode} report for {seconds} seconds")
+
+
 @bot.message_handler(commands=['myid'])
 def handle_my_id_command(message):
     user_id = message.from_user.id
@@ -491,8 +1336,6 @@ def handle_setup_callback(call):
         save_data(CONFIG_DATA_FILE, config)
         bot.answer_callback_query(call.id, "System prompt removed.")
         logging.info("System prompt removed.")
-        for chat_id in chat_contexts:
-            chat_contexts[chat_id][0] = {"role": "system", "content": global_system_prompt}
     elif call.data == 'show_system_prompt':
         if global_system_prompt:
             bot.answer_callback_query(call.id, f"Current system prompt:\n\n{global_system_prompt}", show_alert=True)
@@ -515,7 +1358,8 @@ def handle_setup_callback(call):
         settings_text += f"**API Model:** `{global_model}`\n"
 
         bot.send_message(chat_id, settings_text, parse_mode='Markdown')
-        logging.info(f"Model set to: {global_model}")
+        logging.info("Model set to: %s", global_model)
+        start_warm_up(warmup_settings["keep_alive"] if is_keep_warm_time() else None)
     elif call.data.startswith('set_parse_mode_'):
         parse_mode = call.data.split('_')[1]
         global_parse_mode = parse_mode
@@ -528,7 +1372,7 @@ def handle_setup_callback(call):
     try:
         bot.delete_message(chat_id=chat_id, message_id=message_id)
     except telebot.apihelper.ApiTelegramException as e:
-        logging.error(f"Error deleting message: {e}")
+        logging.error("Error deleting message: %s", e)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("set_group_mode_"))
@@ -546,61 +1390,315 @@ def handle_set_group_mode_callback(call):
     bot.edit_message_text(chat_id, call.message.message_id, f"Group mode set to: {GROUP_MODES[selected_mode]}")
 
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
-    global global_host, global_model, global_api_type, chat_contexts, group_mode, global_api_key, global_parse_mode, max_context_tokens
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    message_id = message.message_id
+@bot.callback_query_handler(func=lambda call: call.data.startswith("set_cancel_policy_"))
+def handle_set_cancel_policy_callback(call):
+    global cancel_policy, config
+    if call.from_user.id != ADMIN_USER_ID:
+        bot.answer_callback_query(call.id, "You don't have permission to use this command.")
+        return
 
-    logging.info(f"Received message from user {user_id} in chat {chat_id}: {message.text}")
+    chat_id = call.message.chat.id
+    selected_policy = call.data.replace("set_cancel_policy_", "")
 
+    config["cancel_policy"] = selected_policy
+    save_data(CONFIG_DATA_FILE, config)
+
+    cancel_policy = selected_policy
+
+    bot.answer_callback_query(call.id, f"Cancel policy set to: {CANCEL_POLICIES[selected_policy]}")
+    bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id,
+                          text=f"Cancel policy set to: {CANCEL_POLICIES[selected_policy]}")
+
+
+def should_respond(message, text):
+    chat_id = message.chat.id
+    user_id = message.from_user.id
     if message.chat.type != 'private':
         if group_mode == "respond_to_mentions_only":
-            if not (message.text.startswith(f'@{BOT_USERNAME}') or
-                    (message.reply_to_message and
-                     message.reply_to_message.from_user.id == bot.get_me().id)):
+            if not (text.startswith(f'@{BOT_USERNAME}') or is_reply_to_bot(message)):
                 logging.debug("Ignoring message as it is not a private chat or a direct mention.")
-                return
+                return False
         elif group_mode == "respond_to_allowed_users":
             if not global_allow_all_users and str(user_id) not in allowed_users:
                 logging.debug("Ignoring message as user is not authorized.")
-                return
+                return False
     else:
         if not global_allow_all_users and str(user_id) not in allowed_users:
             bot.send_message(chat_id, "Sorry, you do not have access to this bot.")
-            logging.warning(f"User {user_id} is not allowed to use the bot.")
-            return
+            logging.warning("User %s is not allowed to use the bot.", user_id)
+            return False
+
+    return check_config(chat_id)
 
-    if not check_config(chat_id):
+
+@bot.message_handler(content_types=['document'])
+def handle_document(message):
+    document = message.document
+    caption = message.caption or ""
+    logging.info("Received document %s (%s bytes) from user %s in chat %s",
+                 document.file_name, document.file_size, message.from_user.id, message.chat.id)
+
+    if not should_respond(message, caption):
+        return
+    if not document_settings["enabled"]:
+        bot.reply_to(message, "Documents are not supported.")
+        return
+    if not lexi_documents.is_text_document(document.file_name, document.mime_type):
+        bot.reply_to(message, "Only text documents are supported.")
+        return
+    max_file_bytes = min(document_settings["max_file_bytes"], document_settings["max_chat_bytes"])
+    if document.file_size and document.file_size > max_file_bytes:
+        bot.reply_to(message, f"The file is too large. The limit is {max_file_bytes // 1024} KB.")
+        return
+
+    context_key = get_context_key(message)
+    if context_key not in chat_contexts:
+        chat_contexts[context_key] = lexi_history.ChatHistory()
+    # Tokenizing a large file takes a while; with CPU offload enabled it runs in
+    # the worker pool and the handler thread is free for the next update.
+    lexi_cpu.submit(ingest_document, message, context_key, max_file_bytes)
+
+
+def ingest_document(message, context_key, max_file_bytes):
+    document = message.document
+    caption = message.caption or ""
+    try:
+        path, size = lexi_documents.download(bot.get_file_url(document.file_id), max_file_bytes, api_request_timeout)
+    except lexi_documents.DocumentTooLarge:
+        bot.reply_to(message, f"The file is too large. The limit is {max_file_bytes // 1024} KB.")
+        return
+    except requests.exceptions.HTTPError as e:
+        # The file URL, and so the text of most download errors, contains the bot token.
+        logging.error("Error downloading document: HTTP %s", e.response.status_code)
+        bot.reply_to(message, "Could not download the file.")
+        return
+    except Exception as e:
+        logging.error("Error downloading document: %s", type(e).__name__)
+        bot.reply_to(message, "Could not download the file.")
+        return
+
+    try:
+        chunks = list(lexi_documents.split_tokens(lexi_documents.iter_text(path), get_encoding(global_model),
+                                                  document_settings["chunk_tokens"]))
+    finally:
+        os.remove(path)
+
+    name = document.file_name or "document"
+    document_store.add(context_key, message.chat.id, name, chunks)
+    total_tokens = sum(tokens for _, tokens in chunks)
+    logging.info("Stored document %s: %s bytes, %s tokens in %s chunks.", name, size, total_tokens, len(chunks))
+
+    question = caption.replace(f'@{BOT_USERNAME}', '').strip()
+    if question:
+        queue_user_message(message, f"[Attached document: {name}]\n{question}", context_key)
+    else:
+        bot.reply_to(message, f"I've read {name} ({total_tokens} tokens). Ask me anything about it.")
+
+
+@bot.message_handler(func=lambda message: True)
+def handle_message(message):
+    global global_host, global_model, global_api_type, chat_contexts, group_mode, global_api_key, global_parse_mode, max_context_tokens
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    message_id = message.message_id
+
+    logging.info("Received message from user %s in chat %s (%s characters)", user_id, chat_id, len(message.text))
+    logging.debug("Message text: %s", message.text)
+
+    if not should_respond(message, message.text):
         return
 
     user_message = message.text.replace(f'@{BOT_USERNAME}', '').strip()
 
-    if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = [{"role": "system", "content": global_system_prompt}]
-
-    chat_contexts[chat_id].append({"role": "user", "content": user_message})
-
-    send_api_request(
-        chat_id=chat_id,
-        reply_to_message_id=message_id,
-        api_type=global_api_type,
-        host=global_host,
-        model=global_model,
-        api_key=global_api_key,
-        system_prompt=global_system_prompt,
-        parse_mode=global_parse_mode,
-        bot=bot,
-        typing_active=typing_active,
-        api_request_timeout=api_request_timeout,
-        max_context_tokens=max_context_tokens
-    )
+    context_key = get_context_key(message)
+    if context_key not in chat_contexts:
+        chat_contexts[context_key] = lexi_history.ChatHistory()
+
+    queue_user_message(message, user_message, context_key)
+
+
+def queue_user_message(message, user_message, context_key=None):
+    turn_key = (message.chat.id if context_key is None else context_key, message.from_user.id)
+    with pending_turns_lock:
+        turn = pending_turns.get(turn_key)
+        if turn is not None:
+            # The user is still typing, or their previous turn is waiting for a worker:
+            # fold this message into that turn instead of starting another generation.
+            turn["texts"].append(user_message)
+            turn["message"] = message
+            if turn["timer"] is not None:
+                turn["timer"].cancel()
+                turn["timer"] = start_coalesce_timer(turn_key)
+            logging.info("Merged message into pending turn for chat %s (%s messages).",
+                         message.chat.id, len(turn['texts']))
+            return
+
+        turn = {"texts": [user_message], "message": message, "timer": None,
+                "trace": lexi_trace.start_trace("message", tenant=TENANT_NAME, chat=message.chat.id,
+                                                user=message.from_user.id)}
+        pending_turns[turn_key] = turn
+        if coalesce_window_ms > 0:
+            turn["timer"] = start_coalesce_timer(turn_key)
+            return
+
+    submit_pending_turn(turn_key)
+
+
+def start_coalesce_timer(turn_key):
+    # The timer passes itself, so one that fired just as a new message replaced
+    # it cannot submit the turn a second time.
+    timer = threading.Timer(coalesce_window_ms / 1000, lambda: submit_pending_turn(turn_key, timer))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def take_pending_turn(turn_key, turn):
+    with pending_turns_lock:
+        if pending_turns.get(turn_key) is turn:
+            del pending_turns[turn_key]
+        return "\n".join(turn["texts"]), turn["message"]
+
+
+def submit_pending_turn(turn_key, timer=None):
+    # The turn leaves pending_turns while it is counted, so a failure cannot
+    # leave it there to swallow the user's later messages.
+    with pending_turns_lock:
+        turn = pending_turns.get(turn_key)
+        if turn is None or turn["timer"] is not timer:
+            return
+        del pending_turns[turn_key]
+        turn["timer"] = None
+        message = turn["message"]
+        trace = turn["trace"]
+        lexi_trace.add_span("coalesce", time.perf_counter() - trace["start"], trace, offset=0)
+        submitted = time.perf_counter()
+        pending_text = "\n".join(turn["texts"])
+
+    context_key, user_id = turn_key
+    chat_id = message.chat.id
+    try:
+        # Counted outside the lock, which every chat's incoming messages contend for.
+        pending_tokens = count_tokens([{"role": "user", "content": pending_text}], global_model)
+    except Exception as e:
+        logging.error("Error counting tokens for chat %s: %s", chat_id, e)
+        bot.reply_to(message, "Error: Could not process your message.")
+        return
+
+    with pending_turns_lock:
+        newer_turn = pending_turns.get(turn_key)
+        if newer_turn is not None:
+            # Messages sent while this one was counted started a new turn; it
+            # takes this turn's messages along.
+            newer_turn["texts"][:0] = turn["texts"]
+            return
+        # Until a worker takes it, later messages are folded into this turn.
+        pending_turns[turn_key] = turn
+    cancel_token, previous_token = track_request(turn_key)
+
+    def process_request():
+        lexi_trace.add_span("queue", time.perf_counter() - submitted, trace, offset=submitted - trace["start"])
+        user_message, last_message = take_pending_turn(turn_key, turn)
+        if cancel_token.cancelled:
+            logging.info("Skipping cancelled request for chat %s: %s", chat_id, cancel_token.reason)
+            return
+        history = chat_contexts.get(context_key)
+        if history is None:
+            # The thread was evicted while this request waited in the queue.
+            history = chat_contexts[context_key] = lexi_history.ChatHistory()
+        history.append("user", user_message)
+        try:
+            with lexi_trace.activate(trace):
+                lexi_trace.run(
+                    send_api_request,
+                    chat_id=chat_id,
+                    reply_to_message_id=last_message.message_id,
+                    bot=bot,
+                    typing_active=typing_active,
+                    user_id=user_id,
+                    cancel_token=cancel_token,
+                    chat_type=last_message.chat.type,
+                    context_key=context_key,
+                    **get_request_settings()
+                )
+        finally:
+            release_request(turn_key, cancel_token)
+            lexi_trace.finish_trace(trace, messages=len(turn["texts"]), cancelled=cancel_token.cancelled)
+
+    def expire_request():
+        _, last_message = take_pending_turn(turn_key, turn)
+        release_request(turn_key, cancel_token)
+        bot.reply_to(last_message, BUSY_MESSAGE)
+
+    deadline = None
+    if api_request_timeout:
+        deadline = time.monotonic() + api_request_timeout
+
+    try:
+        admitted, reason = lexi_admission.submit(
+            user_id=user_id,
+            chat_id=chat_id,
+            job=process_request,
+            priority=get_request_priority(message),
+            tokens=pending_tokens,
+            deadline=deadline,
+            on_expired=expire_request,
+            exempt=user_id == ADMIN_USER_ID,
+            tenant=TENANT_NAME
+        )
+    except Exception as e:
+        logging.error("Error submitting request from chat %s: %s", chat_id, e)
+        _, last_message = take_pending_turn(turn_key, turn)
+        release_request(turn_key, cancel_token, previous_token)
+        bot.reply_to(last_message, "Error: Could not process your message.")
+        return
+    if not admitted:
+        logging.warning("Request from user %s in chat %s rejected: %s", user_id, chat_id, reason)
+        _, last_message = take_pending_turn(turn_key, turn)
+        release_request(turn_key, cancel_token, previous_token)
+        bot.reply_to(last_message, BUSY_MESSAGE)
+        return
+
+    supersede_request(previous_token)
+
+
+def get_bot_id():
+    global bot_id
+    if bot_id is None:
+        bot_id = bot.get_me().id
+    return bot_id
+
+
+def is_reply_to_bot(message):
+    return bool(message.reply_to_message and message.reply_to_message.from_user and
+                message.reply_to_message.from_user.id == get_bot_id())
+
+
+def record_incoming_messages(messages):
+    for message in messages:
+        text = message.text or message.caption or ""
+        try:
+            lexi_recorder.record_message(
+                message,
+                is_admin=message.from_user is not None and message.from_user.id == ADMIN_USER_ID,
+                mentions_bot=text.startswith(f'@{BOT_USERNAME}'),
+                replies_to_bot=is_reply_to_bot(message)
+            )
+        except Exception as e:
+            logging.error("Error recording message: %s", e)
+
+
+def get_request_priority(message):
+    if message.from_user.id == ADMIN_USER_ID:
+        return lexi_admission.PRIORITY_ADMIN
+    if message.chat.type == 'private':
+        return lexi_admission.PRIORITY_PRIVATE
+    return lexi_admission.PRIORITY_GROUP
 
 
 def start_setup_admin(chat_id):
     global chat_contexts
-    chat_contexts[chat_id] = [{"role": "system", "content": global_system_prompt}]
+    chat_contexts[chat_id] = lexi_history.ChatHistory()
     markup = telebot.types.InlineKeyboardMarkup()
     for api_type in lexi_ai_api.SUPPORTED_API_TYPES:
         markup.add(telebot.types.InlineKeyboardButton(api_type, callback_data=f"setapi_{api_type}"))
@@ -657,7 +1755,7 @@ def ask_api_model(chat_id):
 
 def show_available_models_for_api(chat_id, api_key=None):
     global global_api_type, global_host
-    logging.info(f"Showing available models for {global_api_type} API to chat {chat_id}")
+    logging.info("Showing available models for %s API to chat %s", global_api_type, chat_id)
     available_models = lexi_ai_api.get_available_models(global_host, api_type=global_api_type, api_key=api_key)
     if available_models:
         markup = telebot.types.InlineKeyboardMarkup()
@@ -706,7 +1804,7 @@ def get_user_id_to_add(message):
             allowed_users[str(user_id_to_add)] = user_id_to_add
             save_data(USER_DATA_FILE, allowed_users)
             bot.reply_to(message, f"User with ID {user_id_to_add} successfully added.")
-            logging.info(f"User {user_id_to_add} added to allowed users.")
+            logging.info("User %s added to allowed users.", user_id_to_add)
     except (ValueError, telebot.apihelper.ApiTelegramException) as e:
         bot.reply_to(message, f"Invalid user ID or an error occurred: {e}")
 
@@ -719,7 +1817,7 @@ def get_user_id_to_delete(message):
             del allowed_users[str(user_id_to_delete)]
             save_data(USER_DATA_FILE, allowed_users)
             bot.reply_to(message, f"User with ID {user_id_to_delete} successfully deleted.")
-            logging.info(f"User {user_id_to_delete} removed from allowed users.")
+            logging.info("User %s removed from allowed users.", user_id_to_delete)
         else:
             bot.reply_to(message, f"User with ID {user_id_to_delete} not found in the allowed list.")
     except ValueError:
@@ -732,6 +1830,8 @@ def get_timeout_value(message):
         new_timeout = int(message.text)
         if new_timeout >= 0:
             api_request_timeout = new_timeout
+            config["api_request_timeout"] = api_request_timeout
+            save_data(CONFIG_DATA_FILE, config)
             bot.reply_to(message, f"API request timeout set to {api_request_timeout} seconds.")
         else:
             bot.reply_to(message, "Timeout value must be greater than or equal to zero.")
@@ -745,12 +1845,72 @@ def get_system_prompt_from_user(message):
     config["system_prompt"] = global_system_prompt
     save_data(CONFIG_DATA_FILE, config)
     bot.reply_to(message, f"System prompt set to:\n\n{global_system_prompt}")
-    logging.info(f"System prompt set to: {global_system_prompt}")
-    for chat_id in chat_contexts:
-        chat_contexts[chat_id][0] = {"role": "system", "content": global_system_prompt}
-
-
-load_data()
-
-logging.info("Bot started and listening for messages.")
-bot.polling(none_stop=True)
\ No newline at end of file
+    logging.info("System prompt set to: %s", global_system_prompt)
+
+
+def get_request_settings():
+    # Read together so a config reload never hands a request a mix of old and
+    # new values.
+    with config_lock:
+        return {
+            "api_type": global_api_type,
+            "host": global_host,
+            "model": global_model,
+            "api_key": global_api_key,
+            "system_prompt": global_system_prompt,
+            "parse_mode": global_parse_mode,
+            "api_request_timeout": api_request_timeout,
+            "max_context_tokens": max_context_tokens
+        }
+
+
+def reload():
+    # Plugins first, so a config that switches to a new plugin finds it. Requests
+    # already running finish with the plugin and settings they started with.
+    global usage_stats
+    reloaded, removed = lexi_ai_api.reload_api_plugins()
+    plugins_text = f"Plugins reloaded: {', '.join(reloaded) or 'none'}, removed: {', '.join(removed) or 'none'}."
+    try:
+        load_json_data(CONFIG_DATA_FILE, default={})
+    except ValueError as e:
+        logging.error("Not reloading %s: %s", CONFIG_DATA_FILE, e)
+        return f"{plugins_text} The configuration was not reloaded, it is not valid JSON: {e}"
+
+    previous_backend = (global_api_type, global_host, global_model)
+    with config_lock:
+        # Usage counters live in memory while running; the file may be behind.
+        with usage_lock:
+            current_usage = usage_stats
+        load_data()
+        usage_stats = current_usage
+    if (global_api_type, global_host, global_model) != previous_backend:
+        start_warm_up(warmup_settings["keep_alive"] if is_keep_warm_time() else None)
+    logging.info("Reloaded configuration and plugins.")
+    return f"{plugins_text} Configuration reloaded."
+
+
+def start_reload(signum=None, frame=None):
+    # Signal handlers run on the main thread, so the work is handed to a thread
+    # to keep polling going.
+    threading.Thread(target=reload, name="lexi-reload", daemon=True).start()
+
+
+def start_services():
+    load_data()
+    start_warm_up(warmup_settings["keep_alive"] if is_keep_warm_time() else None)
+    lexi_admission.start()
+    threading.Thread(target=run_maintenance, name="lexi-maintenance", daemon=True).start()
+
+    record_file = os.environ.get("LEXI_RECORD_FILE")
+    if record_file:
+        lexi_recorder.start(record_file)
+        bot.set_update_listener(record_incoming_messages)
+
+
+if __name__ == "__main__":
+    start_services()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, start_reload)
+
+    logging.info("Bot started and listening for messages.")
+    bot.polling(none_stop=True)
@@ -0,0 +1,255 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+PRIORITY_ADMIN = 0
+PRIORITY_PRIVATE = 1
+PRIORITY_GROUP = 2
+
+DEFAULT_SETTINGS = {
+    "max_queue_size": 32,
+    "workers": 2,
+    "window_seconds": 60,
+    "user_max_requests": 10,
+    "user_max_tokens": 20000,
+    "chat_max_requests": 30,
+    "chat_max_tokens": 60000,
+    "queue_deadline": 120
+}
+
+settings = dict(DEFAULT_SETTINGS)
+tenant_settings = {}
+tenant_limits = {}
+tenant_running = Counter()
+tenant_queued = Counter()
+deferred = {}
+queued_items = 0
+request_queue = None
+workers = []
+usage_windows = {}
+usage_lock = threading.Lock()
+sequence = itertools.count()
+service_time = None
+stats = {
+    "admitted": 0,
+    "shed_queue_full": 0,
+    "shed_budget": 0,
+    "shed_deadline": 0,
+    "expired": 0,
+    "completed": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0
+}
+
+
+def configure(new_settings=None, tenant=None):
+    global settings
+    if tenant is not None:
+        # Tenants get their own budgets on top of the process-wide settings;
+        # the queue and worker pool stay shared.
+        tenant_settings[tenant] = {**settings, **(new_settings or {})}
+        logging.info("Admission settings for tenant %s: %s", tenant, tenant_settings[tenant])
+        return
+    settings = dict(DEFAULT_SETTINGS)
+    if new_settings:
+        settings.update(new_settings)
+    logging.info("Admission settings: %s", settings)
+
+
+def set_tenant_limits(tenant, max_concurrency=0, max_queued=0):
+    tenant_limits[tenant] = {"max_concurrency": max_concurrency, "max_queued": max_queued}
+    logging.info("Tenant %s limited to %s concurrent and %s queued requests.",
+                 tenant, max_concurrency or "unlimited", max_queued or "unlimited")
+
+
+def get_settings(tenant=None):
+    return tenant_settings.get(tenant, settings)
+
+
+def start():
+    global request_queue
+    if request_queue is not None:
+        return
+    # The queue itself is unbounded so deferred requests can always be put back;
+    # max_queue_size is enforced on admission instead.
+    request_queue = queue.PriorityQueue()
+    for index in range(settings["workers"]):
+        worker = threading.Thread(target=worker_loop, name=f"lexi-admission-{index}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    logging.info("Admission controller started with %s workers.", len(workers))
+
+
+def get_window(key, window_seconds=None):
+    window = usage_windows.get(key)
+    if window is None:
+        window = usage_windows[key] = deque()
+    cutoff = time.monotonic() - (window_seconds or settings["window_seconds"])
+    while window and window[0][0] < cutoff:
+        window.popleft()
+    return window
+
+
+def is_over_budget(key, max_requests, max_tokens, tokens, window_seconds=None):
+    window = get_window(key, window_seconds)
+    if max_requests and sum(entry[1] for entry in window) >= max_requests:
+        return True
+    if max_tokens and sum(entry[2] for entry in window) + tokens > max_tokens:
+        return True
+    return False
+
+
+def record_usage(user_id, chat_id, tokens, tenant=None):
+    now = time.monotonic()
+    window_seconds = get_settings(tenant)["window_seconds"]
+    with usage_lock:
+        get_window(("user", tenant, user_id), window_seconds).append((now, 0, tokens))
+        get_window(("chat", tenant, chat_id), window_seconds).append((now, 0, tokens))
+
+
+def is_idle():
+    return queued_items == 0 and sum(tenant_running.values()) < len(workers)
+
+
+def expected_wait():
+    # Rough queueing estimate: everything ahead of us is served by the worker pool
+    # at the recently observed per-request service time.
+    if service_time is None or request_queue is None:
+        return 0
+    return (queued_items / max(len(workers), 1) + 1) * service_time
+
+
+def submit(user_id, chat_id, job, priority=PRIORITY_GROUP, tokens=0, deadline=None, on_expired=None, exempt=False,
+           tenant=None):
+    global queued_items
+    if request_queue is None:
+        start()
+
+    budget = get_settings(tenant)
+    now = time.monotonic()
+    if deadline is None:
+        deadline = now + budget["queue_deadline"]
+    user_key = ("user", tenant, user_id)
+    chat_key = ("chat", tenant, chat_id)
+
+    with usage_lock:
+        if not exempt:
+            if is_over_budget(user_key, budget["user_max_requests"], budget["user_max_tokens"], tokens,
+                              budget["window_seconds"]):
+                stats["shed_budget"] += 1
+                logging.warning("User %s is over budget. Shedding request.", user_id)
+                return False, "user_budget"
+            if is_over_budget(chat_key, budget["chat_max_requests"], budget["chat_max_tokens"], tokens,
+                              budget["window_seconds"]):
+                stats["shed_budget"] += 1
+                logging.warning("Chat %s is over budget. Shedding request.", chat_id)
+                return False, "chat_budget"
+
+        # A request that finds a worker idle is always taken, so a service time
+        # inflated by a few slow requests cannot shed everything that follows.
+        if not exempt and not is_idle() and now + expected_wait() > deadline:
+            stats["shed_deadline"] += 1
+            logging.warning("Request from chat %s cannot be answered before its deadline. Shedding request.", chat_id)
+            return False, "deadline"
+
+        if queued_items >= settings["max_queue_size"]:
+            stats["shed_queue_full"] += 1
+            logging.warning("Request queue is full. Shedding request from chat %s.", chat_id)
+            return False, "queue_full"
+        max_queued = tenant_limits.get(tenant, {}).get("max_queued")
+        if max_queued and tenant_queued[tenant] >= max_queued:
+            stats["shed_queue_full"] += 1
+            logging.warning("Tenant %s has too many queued requests. Shedding request from chat %s.", tenant, chat_id)
+            return False, "tenant_queue_full"
+
+        item = {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "tenant": tenant,
+            "job": job,
+            "on_expired": on_expired,
+            "exempt": exempt,
+            "deadline": deadline,
+            "enqueued": now
+        }
+        request_queue.put((priority, next(sequence), item))
+        queued_items += 1
+        tenant_queued[tenant] += 1
+
+        # Tokens are only recorded once the answer is in, by record_usage.
+        get_window(user_key, budget["window_seconds"]).append((now, 1, 0))
+        get_window(chat_key, budget["window_seconds"]).append((now, 1, 0))
+        stats["admitted"] += 1
+
+    logging.info("Admitted request from user %s in chat %s with priority %s.", user_id, chat_id, priority)
+    return True, None
+
+
+def worker_loop():
+    global service_time, queued_items
+    while True:
+        entry = request_queue.get()
+        priority, _, item = entry
+        tenant = item["tenant"]
+        with usage_lock:
+            max_concurrency = tenant_limits.get(tenant, {}).get("max_concurrency")
+            if max_concurrency and tenant_running[tenant] >= max_concurrency:
+                # Park the request until one of this tenant's running requests
+                # finishes, so a busy tenant cannot occupy every worker.
+                deferred.setdefault(tenant, deque()).append(entry)
+                request_queue.task_done()
+                continue
+            tenant_running[tenant] += 1
+            tenant_queued[tenant] -= 1
+            queued_items -= 1
+
+            started = time.monotonic()
+            waited = started - item["enqueued"]
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            # Only give up on a request that others are waiting behind, or whose
+            # deadline has already passed.
+            expired = not item["exempt"] and (started > item["deadline"] or (
+                queued_items and started + (service_time or 0) > item["deadline"]))
+            if expired:
+                stats["expired"] += 1
+
+        try:
+            if expired:
+                logging.warning(
+                    "Dropping request from chat %s: waited %.1fs and can no longer be answered in time.",
+                    item['chat_id'], waited
+                )
+                if item["on_expired"]:
+                    item["on_expired"]()
+                continue
+
+            item["job"]()
+
+            # One request stuck until its backend timed out should not dominate the estimate.
+            elapsed = min(time.monotonic() - started, (item["deadline"] - item["enqueued"]) / 2)
+            with usage_lock:
+                service_time = elapsed if service_time is None else service_time * 0.8 + elapsed * 0.2
+                stats["completed"] += 1
+        except Exception as e:
+            logging.error("Error processing request from chat %s: %s", item['chat_id'], e)
+        finally:
+            with usage_lock:
+                tenant_running[tenant] -= 1
+                waiting = deferred.get(tenant)
+                if waiting:
+                    request_queue.put(waiting.popleft())
+            request_queue.task_done()
+
+
+def get_stats():
+    return {
+        **stats,
+        "queued": queued_items,
+        "service_time": service_time,
+        "tenants": {tenant: {"running": tenant_running[tenant], "queued": tenant_queued[tenant]}
+                    for tenant in set(tenant_running) | set(tenant_queued) if tenant is not None}
+    }
@@ -1,104 +1,261 @@
+import importlib.util
 import json
 import logging
-import requests
 import os
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import sys
+import threading
+import time
 from importlib import import_module
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-# logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+import lexi_deadlines
+import lexi_logging
+import lexi_trace
+from lexi_http import CancelToken, Deadline, RequestCancelled, preconnect
+from requests.exceptions import Timeout
 
-API_PLUGINS_DIR = "api_plugins"
+lexi_logging.setup()
 
-adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]))
-session = requests.Session()
-session.mount('https://', adapter)
-session.mount('http://', adapter)
+API_PLUGINS_DIR = "api_plugins"
 
 SUPPORTED_API_TYPES = {}
+model_capabilities = {}
+plugin_files = {}
+reload_lock = threading.Lock()
 
 
 def load_api_plugins(plugin_dir=API_PLUGINS_DIR):
-    logging.debug(f"Loading API plugins from directory: {plugin_dir}")
+    logging.debug("Loading API plugins from directory: %s", plugin_dir)
     plugins = {}
     for filename in os.listdir(plugin_dir):
         if filename.endswith(".py") and filename != "__init__.py":
             module_name = filename[:-3]
-            logging.debug(f"Loading plugin module: {module_name}")
+            logging.debug("Loading plugin module: %s", module_name)
             try:
                 module = import_module(f"{plugin_dir}.{module_name}")
                 plugin_name = getattr(module, "PLUGIN_NAME", None)
                 if plugin_name:
                     plugins[plugin_name] = module
-                    logging.debug(f"Plugin '{plugin_name}' loaded successfully.")
+                    plugin_files[module_name] = {"mtime": os.path.getmtime(os.path.join(plugin_dir, filename)),
+                                                 "plugin_name": plugin_name}
+                    logging.debug("Plugin '%s' loaded successfully.", plugin_name)
                 else:
-                    logging.warning(f"Plugin in file {filename} skipped: PLUGIN_NAME not found.")
+                    logging.warning("Plugin in file %s skipped: PLUGIN_NAME not found.", filename)
             except ImportError as e:
-                logging.error(f"Error importing plugin {filename}: {e}")
+                logging.error("Error importing plugin %s: %s", filename, e)
             except AttributeError as e:
-                logging.error(f"Error loading plugin from {filename}: {e}")
+                logging.error("Error loading plugin from %s: %s", filename, e)
             except Exception as e:
-                logging.error(f"Error loading plugin {filename}: {e}")
-    logging.debug(f"Loaded plugins: {plugins}")
+                logging.error("Error loading plugin %s: %s", filename, e)
+    logging.debug("Loaded plugins: %s", plugins)
     return plugins
 
 
+def load_fresh_module(plugin_dir, module_name):
+    # Builds a new module object rather than reloading in place, so requests
+    # still running in the old version keep their own functions and globals.
+    # Modules the plugin imports, such as lexi_http with its connection pool,
+    # are not reloaded and stay shared.
+    name = f"{plugin_dir}.{module_name}"
+    spec = importlib.util.spec_from_file_location(name, os.path.join(plugin_dir, f"{module_name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+
+def reload_api_plugins(plugin_dir=API_PLUGINS_DIR):
+    # Loads plugin files that changed since they were loaded and swaps the
+    # registry in one assignment. A plugin that fails to load keeps its
+    # previous version.
+    global SUPPORTED_API_TYPES
+    with reload_lock:
+        plugins = dict(SUPPORTED_API_TYPES)
+        reloaded, removed = [], []
+        found = set()
+        for filename in sorted(os.listdir(plugin_dir)):
+            if not filename.endswith(".py") or filename == "__init__.py":
+                continue
+            module_name = filename[:-3]
+            found.add(module_name)
+            mtime = os.path.getmtime(os.path.join(plugin_dir, filename))
+            loaded = plugin_files.get(module_name)
+            if loaded and loaded["mtime"] == mtime:
+                continue
+            try:
+                module = load_fresh_module(plugin_dir, module_name)
+            except Exception as e:
+                logging.error("Error reloading plugin %s, keeping the loaded version: %s", filename, e)
+                continue
+            plugin_name = getattr(module, "PLUGIN_NAME", None)
+            if not plugin_name:
+                logging.warning("Plugin in file %s skipped: PLUGIN_NAME not found.", filename)
+                continue
+            if loaded:
+                plugins.pop(loaded["plugin_name"], None)
+            plugins[plugin_name] = module
+            plugin_files[module_name] = {"mtime": mtime, "plugin_name": plugin_name}
+            reloaded.append(plugin_name)
+        for module_name in set(plugin_files) - found:
+            plugin_name = plugin_files.pop(module_name)["plugin_name"]
+            plugins.pop(plugin_name, None)
+            removed.append(plugin_name)
+
+        if reloaded or removed:
+            model_capabilities.clear()
+            SUPPORTED_API_TYPES = plugins
+            logging.info("Reloaded plugins %s, removed %s.", reloaded, removed)
+        return reloaded, removed
+
+
 def is_host_available(host, api_type, api_key=None):
-    logging.info(f"Checking availability of host {host} for {api_type} API...")
+    logging.info("Checking availability of host %s for %s API...", host, api_type)
 
     plugin = SUPPORTED_API_TYPES.get(api_type)
     if not plugin:
-        logging.error(f"API '{api_type}' is not supported.")
+        logging.error("API '%s' is not supported.", api_type)
         return False
 
     try:
         is_available = plugin.is_host_available(host=host, api_key=api_key)
-        logging.debug(f"Host availability result: {is_available}")
+        logging.debug("Host availability result: %s", is_available)
         return is_available
     except Exception as e:
-        logging.error(f"Error checking host availability: {e}")
+        logging.error("Error checking host availability: %s", e)
         return False
 
 
 def get_available_models(host, api_type, api_key=None):
-    logging.info(f"Getting available models from host {host} for {api_type} API...")
+    logging.info("Getting available models from host %s for %s API...", host, api_type)
     models = []
 
     plugin = SUPPORTED_API_TYPES.get(api_type)
     if not plugin:
-        logging.error(f"API '{api_type}' is not supported.")
+        logging.error("API '%s' is not supported.", api_type)
         return models
 
     try:
         models = plugin.get_available_models(host=host, api_key=api_key)
-        logging.info(f"Available models: {models}")
+        logging.info("Found %s available models.", len(models) if models else 0)
+        logging.debug("Available models: %s", models)
         return models
     except Exception as e:
-        logging.error(f"Error fetching models: {e}")
+        logging.error("Error fetching models: %s", e)
         return models
 
 
-def send_api_request(api_type, host, model, api_key, messages, system_prompt=None, api_request_timeout=120):
-    logging.info(f"Sending API request to {api_type}...")
+def get_model_capabilities(host, api_type, model, api_key=None):
+    key = (api_type, host, model)
+    if key in model_capabilities:
+        return model_capabilities[key]
+
+    plugin = SUPPORTED_API_TYPES.get(api_type)
+    if not plugin or not hasattr(plugin, "get_model_capabilities"):
+        return {}
+
+    logging.info("Fetching capabilities of model %s from %s...", model, api_type)
+    try:
+        capabilities = plugin.get_model_capabilities(host=host, model=model, api_key=api_key)
+    except Exception as e:
+        logging.error("Error fetching model capabilities: %s", e)
+        return {}
+    logging.info("Capabilities of model %s: %s", model, capabilities)
+    model_capabilities[key] = capabilities
+    return capabilities
+
+
+def warm_up(host, api_type, model, api_key=None, keep_alive=None, connections=1, context_length=None):
+    plugin = SUPPORTED_API_TYPES.get(api_type)
+    if not plugin:
+        raise ValueError(f"Error: API '{api_type}' is not supported.")
+
+    started = time.monotonic()
+    preconnect(host, connections)
+    get_model_capabilities(host, api_type, model, api_key)
+    if hasattr(plugin, "warm_up"):
+        # Older plugins' warm_up does not take context_length.
+        kwargs = {"context_length": context_length} if context_length else {}
+        plugin.warm_up(host=host, model=model, api_key=api_key, keep_alive=keep_alive, **kwargs)
+    elapsed = time.monotonic() - started
+    logging.info("Warmed up %s model %s in %.1fs.", api_type, model, elapsed)
+    return elapsed
+
+
+def get_embeddings(api_type, host, model, api_key, texts, api_request_timeout=120):
+    logging.info("Requesting %s embeddings from %s...", len(texts), api_type)
 
     plugin = SUPPORTED_API_TYPES.get(api_type)
     if not plugin:
         raise ValueError(f"Error: API '{api_type}' is not supported.")
+    if not hasattr(plugin, "get_embeddings"):
+        raise ValueError(f"Error: API '{api_type}' does not support embeddings.")
 
     try:
-        response = plugin.send_api_request(
+        return plugin.get_embeddings(
             host=host,
             model=model,
             api_key=api_key,
-            messages=messages,
-            system_prompt=system_prompt,
+            texts=texts,
             api_request_timeout=api_request_timeout
         )
-        logging.debug(f"API response: {response}")
+    except Exception as e:
+        logging.error("Error during embeddings request: %s", e)
+        raise
+
+
+def send_api_request(api_type, host, model, api_key, messages, system_prompt=None, api_request_timeout=120,
+                     cancel_token=None, max_tokens=None, context_length=None):
+    logging.info("Sending API request to %s...", api_type)
+
+    plugin = SUPPORTED_API_TYPES.get(api_type)
+    if not plugin:
+        raise ValueError(f"Error: API '{api_type}' is not supported.")
+
+    # api_request_timeout is either a number of seconds or the request's
+    # Deadline, shared with earlier attempts; within it, the backend gets a
+    # deadline adapted to its observed latency.
+    limit = api_request_timeout if isinstance(api_request_timeout, Deadline) else Deadline(api_request_timeout)
+    # Roughly four characters per token; only compared with earlier prompts.
+    prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages) // 4
+    deadline = lexi_deadlines.get_deadline(api_type, host, model, max_tokens, limit, prompt_tokens)
+    started = time.monotonic()
+    try:
+        with lexi_trace.span(f"backend {api_type}"):
+            response = plugin.send_api_request(
+                host=host,
+                model=model,
+                api_key=api_key,
+                messages=messages,
+                system_prompt=system_prompt,
+                api_request_timeout=deadline,
+                cancel_token=cancel_token,
+                max_tokens=max_tokens,
+                context_length=context_length
+            )
+        if isinstance(response, str):
+            response = {"text": response, "prompt_tokens": None, "completion_tokens": None, "timings": {}}
+        logging.debug("API response: %s", response)
+        logging.info(
+            "Token usage: prompt %s, completion %s", response.get('prompt_tokens'), response.get('completion_tokens')
+        )
+        completion_tokens = response.get("completion_tokens")
+        if completion_tokens is None:
+            # Roughly four characters per token, for backends that do not report usage.
+            completion_tokens = len(response["text"]) // 4
+        lexi_deadlines.record(api_type, host, model, time.monotonic() - started,
+                              (response.get("timings") or {}).get("first_token"), completion_tokens, prompt_tokens)
         return response
+    except RequestCancelled:
+        logging.info("API request to %s was cancelled.", api_type)
+        raise
+    except Timeout as e:
+        logging.error("API request to %s timed out: %s", api_type, e)
+        # Only stretch the backend's deadline if it was its own limit that hit,
+        # not the caller's overall timeout.
+        if not limit.expired:
+            lexi_deadlines.record_timeout(api_type, host, model)
+        raise
     except Exception as e:
-        logging.error(f"Error during API request: {e}")
+        logging.error("Error during API request: %s", e)
         raise
 
 SUPPORTED_API_TYPES = load_api_plugins()
\ No newline at end of file
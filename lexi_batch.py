@@ -0,0 +1,218 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lexi_ai_api
+
+write_lock = threading.Lock()
+stats = {"completed": 0, "failed": 0, "skipped": 0, "completion_tokens": 0}
+stats_lock = threading.Lock()
+
+
+class RateLimiter:
+    # Spaces requests evenly at the configured rate; callers sleep outside the lock.
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait:
+            time.sleep(wait)
+
+
+def parse_rate_limits(values):
+    limits = {}
+    for value in values or []:
+        provider, _, per_minute = value.rpartition("=")
+        if not provider:
+            raise ValueError(f"Rate limit '{value}' should look like PROVIDER=REQUESTS_PER_MINUTE.")
+        limits[provider] = RateLimiter(float(per_minute))
+    return limits
+
+
+def load_completed(path):
+    # A job counts as done once it has a result without an error, so failed
+    # jobs are retried when the run is restarted.
+    completed = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut short if the previous run was killed.
+                    continue
+                if "error" not in result:
+                    completed.add(str(result["id"]))
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def read_jobs(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if isinstance(job, str):
+                job = {"prompt": job}
+            job.setdefault("id", line_number)
+            yield job
+
+
+def build_messages(job, system_prompt=None):
+    # Most plugins only read messages, so the system prompt goes in as the
+    # first message, as in the bot.
+    messages = job["messages"] if "messages" in job else [{"role": "user", "content": job["prompt"]}]
+    if system_prompt and not any(message["role"] == "system" for message in messages):
+        messages = [{"role": "system", "content": system_prompt}] + messages
+    return messages
+
+
+def run_job(job, defaults, rate_limits, retries):
+    target = {key: job.get(key) or defaults.get(key) for key in ("api_type", "host", "model", "api_key")}
+    limiter = rate_limits.get(target["api_type"]) or rate_limits.get("*")
+    system_prompt = job.get("system_prompt", defaults.get("system_prompt"))
+    result = {"id": job["id"], "api_type": target["api_type"], "model": target["model"]}
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = lexi_ai_api.send_api_request(
+                api_type=target["api_type"],
+                host=target["host"],
+                model=target["model"],
+                api_key=target["api_key"],
+                messages=build_messages(job, system_prompt),
+                system_prompt=system_prompt,
+                api_request_timeout=defaults["api_request_timeout"],
+                max_tokens=job.get("max_tokens", defaults.get("max_tokens"))
+            )
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+            if attempt < retries:
+                logging.warning("Job %s failed (attempt %s of %s): %s", job["id"], attempt + 1, retries + 1, e)
+                time.sleep(2 ** attempt)
+            continue
+        result.pop("error", None)
+        result.update({
+            "text": response["text"],
+            "prompt_tokens": response.get("prompt_tokens"),
+            "completion_tokens": response.get("completion_tokens"),
+            "latency": round(time.monotonic() - started, 3),
+            "first_token": (response.get("timings") or {}).get("first_token")
+        })
+        break
+    return result
+
+
+def write_result(output, result):
+    with write_lock:
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+    with stats_lock:
+        if "error" in result:
+            stats["failed"] += 1
+        else:
+            stats["completed"] += 1
+            stats["completion_tokens"] += result["completion_tokens"] or 0
+
+
+def report_progress(started, stop, interval):
+    while not stop.wait(interval):
+        elapsed = time.monotonic() - started
+        with stats_lock:
+            snapshot = dict(stats)
+        logging.info(
+            "%s completed, %s failed, %s skipped; %.2f requests/s, %.1f completion tokens/s",
+            snapshot["completed"], snapshot["failed"], snapshot["skipped"],
+            snapshot["completed"] / elapsed, snapshot["completion_tokens"] / elapsed
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through a Lexi backend plugin.")
+    parser.add_argument("input", help="JSONL file with one job per line: {\"id\", \"prompt\" or \"messages\", ...}")
+    parser.add_argument("output", help="JSONL file results are appended to; finished jobs are skipped on restart")
+    parser.add_argument("--config", help="config.json to take api_type, host, model and api_key from")
+    parser.add_argument("--api-type", help="plugin name, for example Ollama")
+    parser.add_argument("--host")
+    parser.add_argument("--model")
+    parser.add_argument("--api-key")
+    parser.add_argument("--system-prompt")
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--timeout", type=float, default=300, help="API request timeout in seconds (0 for infinite)")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--rate-limit", action="append", metavar="PROVIDER=RPM",
+                        help="requests per minute for a plugin, or * for all; may be repeated")
+    parser.add_argument("--retries", type=int, default=2, help="retries per job after a failure")
+    parser.add_argument("--progress", type=float, default=30, help="seconds between progress reports")
+    args = parser.parse_args()
+
+    defaults = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        defaults = {key: config.get(key) for key in ("api_type", "host", "model", "api_key", "system_prompt")}
+    overrides = {
+        "api_type": args.api_type, "host": args.host, "model": args.model, "api_key": args.api_key,
+        "system_prompt": args.system_prompt
+    }
+    defaults.update({key: value for key, value in overrides.items() if value is not None})
+    defaults["max_tokens"] = args.max_tokens
+    defaults["api_request_timeout"] = args.timeout or None
+    rate_limits = parse_rate_limits(args.rate_limit)
+
+    completed = load_completed(args.output)
+    if completed:
+        logging.info("Resuming: %s jobs already have results in %s.", len(completed), args.output)
+
+    # The semaphore keeps at most two batches of jobs read ahead, so the input
+    # is streamed rather than loaded whole.
+    slots = threading.BoundedSemaphore(args.concurrency * 2)
+    started = time.monotonic()
+    stop = threading.Event()
+    threading.Thread(target=report_progress, args=(started, stop, args.progress), daemon=True).start()
+
+    with open(args.output, "a", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="lexi-batch") as executor:
+        def finish(future):
+            try:
+                write_result(output, future.result())
+            finally:
+                slots.release()
+
+        for job in read_jobs(args.input):
+            if str(job["id"]) in completed:
+                with stats_lock:
+                    stats["skipped"] += 1
+                continue
+            slots.acquire()
+            executor.submit(run_job, job, defaults, rate_limits, args.retries).add_done_callback(finish)
+    stop.set()
+
+    elapsed = time.monotonic() - started
+    print(f"Completed: {stats['completed']}")
+    print(f"Failed: {stats['failed']}")
+    print(f"Skipped (already done): {stats['skipped']}")
+    print(f"Elapsed: {elapsed:.1f}s")
+    print(f"Throughput: {stats['completed'] / elapsed:.2f} requests/s, "
+          f"{stats['completion_tokens'] / elapsed:.1f} completion tokens/s")
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lexi_ai_api
+
+BENCH_PROMPTS = (
+    "Reply with the single word: ready.",
+    "What is the capital of France? Answer in one sentence.",
+    "Count from one to ten, separated by commas.",
+    "Write one short sentence about the sea."
+)
+BENCH_MAX_TOKENS = 64
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_request(api_type, host, model, api_key, prompt, api_request_timeout, count_tokens):
+    started = time.perf_counter()
+    try:
+        response = lexi_ai_api.send_api_request(
+            api_type=api_type,
+            host=host,
+            model=model,
+            api_key=api_key,
+            messages=[{"role": "user", "content": prompt}],
+            api_request_timeout=api_request_timeout,
+            max_tokens=BENCH_MAX_TOKENS
+        )
+    except Exception as e:
+        return {"error": str(e) or type(e).__name__}
+    total = time.perf_counter() - started
+    timings = response.get("timings") or {}
+    completion_tokens = response.get("completion_tokens")
+    if completion_tokens is None and count_tokens:
+        completion_tokens = count_tokens(response["text"], model)
+    return {
+        "first_token": timings.get("first_token"),
+        "total": total,
+        "completion_tokens": completion_tokens or 0,
+        "generation_time": total - (timings.get("first_token") or 0)
+    }
+
+
+def summarize(results):
+    successes = [result for result in results if "error" not in result]
+    first_tokens = [result["first_token"] for result in successes if result["first_token"] is not None]
+    totals = [result["total"] for result in successes]
+    generated = sum(result["completion_tokens"] for result in successes)
+    generation_time = sum(result["generation_time"] for result in successes)
+    errors = [result["error"] for result in results if "error" in result]
+    return {
+        "requests": len(results),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(results) if results else 0,
+        "last_error": errors[-1] if errors else None,
+        "first_token_p50": percentile(first_tokens, 0.5),
+        "first_token_p95": percentile(first_tokens, 0.95),
+        "total_p50": percentile(totals, 0.5),
+        "total_p95": percentile(totals, 0.95),
+        "tokens_per_second": generated / generation_time if generation_time > 0 else None
+    }
+
+
+def run_benchmark(api_type, host, api_key, models, requests_per_model=8, concurrency=4, api_request_timeout=120,
+                  count_tokens=None):
+    # Models are measured one after another so they do not compete for the
+    # same backend; requests within a model run concurrently up to the cap.
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="lexi-bench") as executor:
+        for model in models:
+            logging.info("Benchmarking %s model %s with %s requests.", api_type, model, requests_per_model)
+            futures = [
+                executor.submit(run_request, api_type, host, model, api_key, BENCH_PROMPTS[index % len(BENCH_PROMPTS)],
+                                api_request_timeout, count_tokens)
+                for index in range(requests_per_model)
+            ]
+            summaries[model] = summarize([future.result() for future in futures])
+    return {"time": time.time(), "api_type": api_type, "host": host, "models": summaries}
+
+
+def format_seconds(value):
+    return f"{value * 1000:.0f} ms" if value is not None else "n/a"
+
+
+def format_report(run, previous_runs=()):
+    lines = [f"Benchmark of {run['api_type']} at {run['host']}:"]
+    for model, summary in run["models"].items():
+        tokens_per_second = summary["tokens_per_second"]
+        lines.append(
+            f"\n{model}\n"
+            f"  first token p50 {format_seconds(summary['first_token_p50'])}, "
+            f"p95 {format_seconds(summary['first_token_p95'])}\n"
+            f"  total p50 {format_seconds(summary['total_p50'])}, p95 {format_seconds(summary['total_p95'])}\n"
+            f"  {f'{tokens_per_second:.1f}' if tokens_per_second else 'n/a'} tokens/s, "
+            f"errors {summary['errors']}/{summary['requests']}"
+        )
+        if summary["last_error"]:
+            lines.append(f"  last error: {summary['last_error'][:200]}")
+        previous = next((previous_run["models"][model] for previous_run in reversed(previous_runs)
+                         if previous_run["host"] == run["host"] and model in previous_run["models"]), None)
+        if previous and previous["total_p50"] and summary["total_p50"]:
+            change = (summary["total_p50"] - previous["total_p50"]) / previous["total_p50"]
+            lines.append(f"  total p50 {change:+.0%} compared with the previous run "
+                         f"({format_seconds(previous['total_p50'])})")
+    return "\n".join(lines)
@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+DEFAULT_SETTINGS = {
+    "workers": 0,
+    "batch_window_ms": 2,
+    "max_batch_texts": 256,
+    "inline_chars": 2000
+}
+
+settings = dict(DEFAULT_SETTINGS)
+executor = None
+executor_lock = threading.Lock()
+batch_queue = queue.SimpleQueue()
+batcher = None
+stats = {"batches": 0, "texts": 0, "requests": 0}
+
+
+def configure(new_settings=None):
+    global settings, executor, batcher
+    previous_workers = settings["workers"]
+    settings = dict(DEFAULT_SETTINGS)
+    if new_settings:
+        settings.update(new_settings)
+    with executor_lock:
+        if executor is not None and previous_workers != settings["workers"]:
+            executor.shutdown(wait=False)
+            executor = None
+        if settings["workers"] and executor is None:
+            executor = ThreadPoolExecutor(max_workers=settings["workers"], thread_name_prefix="lexi-cpu")
+            logging.info("CPU offload enabled with %s workers.", settings["workers"])
+        if settings["workers"] and batcher is None:
+            batcher = threading.Thread(target=run_batcher, name="lexi-tokenizer", daemon=True)
+            batcher.start()
+
+
+def is_enabled():
+    return executor is not None
+
+
+def log_failure(future):
+    if future.exception() is not None:
+        logging.error("Offloaded task failed: %s", future.exception(), exc_info=future.exception())
+
+
+def submit(function, *args):
+    # Runs inline when offloading is disabled, so callers handle both cases alike.
+    if executor is None:
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+    else:
+        future = executor.submit(function, *args)
+    future.add_done_callback(log_failure)
+    return future
+
+
+def count_texts(encoding, texts):
+    # Special tokens such as <|endoftext|> in a message are counted as plain text.
+    # Short texts are cheaper to encode right away than to hand over; only long
+    # contexts go through the batcher, which caps how many cores they can use.
+    if executor is None or sum(len(text) for text in texts) < settings["inline_chars"]:
+        return [len(encoding.encode(text, disallowed_special=())) for text in texts]
+    future = Future()
+    batch_queue.put((encoding, texts, future))
+    return future.result()
+
+
+def encode_group(encoding, items):
+    texts = [text for _, item_texts, _ in items for text in item_texts]
+    try:
+        counts = [len(tokens) for tokens in encoding.encode_batch(texts, num_threads=settings["workers"],
+                                                                  disallowed_special=())]
+    except Exception:
+        # A text the encoder rejects fails the whole batch; count each request
+        # on its own so the error reaches only the caller that sent it.
+        for _, item_texts, future in items:
+            try:
+                future.set_result([len(encoding.encode(text, disallowed_special=())) for text in item_texts])
+            except Exception as e:
+                future.set_exception(e)
+        return
+    offset = 0
+    for _, item_texts, future in items:
+        future.set_result(counts[offset:offset + len(item_texts)])
+        offset += len(item_texts)
+
+
+def run_batcher():
+    # Collects token counting requests from all threads for a short window and
+    # encodes them in one encode_batch call per encoding. tiktoken releases the
+    # GIL while it encodes, so the work runs in parallel on its own threads.
+    while True:
+        items = [batch_queue.get()]
+        count = len(items[0][1])
+        deadline = time.monotonic() + settings["batch_window_ms"] / 1000
+        while count < settings["max_batch_texts"]:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = batch_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            items.append(item)
+            count += len(item[1])
+
+        groups = {}
+        for item in items:
+            groups.setdefault(id(item[0]), []).append(item)
+        for group in groups.values():
+            try:
+                encode_group(group[0][0], group)
+            except Exception as e:
+                logging.error("Token counting batch failed: %s", e)
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+        stats["batches"] += 1
+        stats["requests"] += len(items)
+        stats["texts"] += count
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import lexi_http
+
+DEFAULT_SETTINGS = {
+    "enabled": True,
+    "window": 50,
+    "min_samples": 5,
+    "percentile": 0.95,
+    "safety_factor": 2.0,
+    "connect_timeout": 5,
+    "min_read_timeout": 15,
+    "min_deadline": 20
+}
+
+settings = dict(DEFAULT_SETTINGS)
+backends = {}
+backends_lock = threading.Lock()
+dirty = False
+
+
+def configure(new_settings=None):
+    global settings
+    settings = dict(DEFAULT_SETTINGS)
+    if new_settings:
+        settings.update(new_settings)
+
+
+def get_key(api_type, host, model):
+    return f"{api_type} {host} {model}"
+
+
+def get_backend(key):
+    backend = backends.get(key)
+    if backend is None:
+        backend = backends[key] = {
+            "first_token": deque(maxlen=settings["window"]),
+            "seconds_per_token": deque(maxlen=settings["window"]),
+            "completion_tokens": deque(maxlen=settings["window"]),
+            "prompt_tokens": deque(maxlen=settings["window"]),
+            "stretch": 1.0,
+            "deadline": None,
+            "read_timeout": None
+        }
+    return backend
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def record(api_type, host, model, latency, first_token, completion_tokens, prompt_tokens=0):
+    global dirty
+    with backends_lock:
+        backend = get_backend(get_key(api_type, host, model))
+        first_token = first_token if first_token is not None else latency
+        backend["first_token"].append(first_token)
+        backend["prompt_tokens"].append(prompt_tokens or 0)
+        if completion_tokens:
+            backend["seconds_per_token"].append(max(latency - first_token, 0) / completion_tokens)
+            backend["completion_tokens"].append(completion_tokens)
+        backend["stretch"] = max(1.0, backend["stretch"] * 0.8)
+        dirty = True
+
+
+def record_timeout(api_type, host, model):
+    # A backend that timed out may be slow (reloading the model, a long answer)
+    # rather than hung, so its next deadlines are stretched, up to four times;
+    # every success shrinks them back.
+    global dirty
+    with backends_lock:
+        backend = get_backend(get_key(api_type, host, model))
+        backend["stretch"] = min(backend["stretch"] * 1.5, 4.0)
+        dirty = True
+    logging.warning("Request to %s %s timed out; extending its next deadlines.", api_type, model)
+
+
+def compute(api_type, host, model, max_tokens, prompt_tokens=0):
+    # Returns (deadline, read timeout) in seconds, or (None, None) until enough
+    # requests have been observed.
+    global dirty
+    with backends_lock:
+        backend = get_backend(get_key(api_type, host, model))
+        if len(backend["first_token"]) < settings["min_samples"]:
+            return None, None
+        first_token = percentile(backend["first_token"], settings["percentile"])
+        # The time to the first token grows with the prompt the backend has to
+        # process, so a prompt longer than usual gets proportionally longer.
+        typical_prompt = percentile(backend["prompt_tokens"], 0.5) if backend["prompt_tokens"] else 0
+        if prompt_tokens and typical_prompt:
+            first_token *= max(1.0, prompt_tokens / typical_prompt)
+        seconds_per_token = percentile(backend["seconds_per_token"], settings["percentile"]) \
+            if backend["seconds_per_token"] else 0
+        # Without a response limit, expect an answer as long as the longer ones seen so far.
+        expected_tokens = max_tokens or (percentile(backend["completion_tokens"], settings["percentile"])
+                                         if backend["completion_tokens"] else 0)
+        # The stretch after a timeout applies on top of the minimums, or it
+        # would do nothing for a backend that is usually fast.
+        factor = settings["safety_factor"]
+        deadline = max(factor * (first_token + expected_tokens * seconds_per_token),
+                       settings["min_deadline"]) * backend["stretch"]
+        read_timeout = min(max(factor * first_token, settings["min_read_timeout"]) * backend["stretch"], deadline)
+        if (deadline, read_timeout) != (backend["deadline"], backend["read_timeout"]):
+            backend["deadline"], backend["read_timeout"] = deadline, read_timeout
+            dirty = True
+    return deadline, read_timeout
+
+
+def get_deadline(api_type, host, model, max_tokens, limit=None, prompt_tokens=0):
+    # limit is the request's overall Deadline; every attempt, including
+    # fallbacks to other backends, has to finish within it.
+    expires = limit.expires if limit else None
+    deadline, read_timeout = compute(api_type, host, model, max_tokens, prompt_tokens) \
+        if settings["enabled"] else (None, None)
+    if deadline is not None:
+        adaptive_expires = time.monotonic() + deadline
+        expires = min(expires, adaptive_expires) if expires is not None else adaptive_expires
+    return lexi_http.Deadline(connect_timeout=settings["connect_timeout"], read_timeout=read_timeout,
+                              expires=expires)
+
+
+def get_snapshot():
+    with backends_lock:
+        return {
+            key: {
+                "samples": len(backend["first_token"]),
+                "first_token_p": percentile(backend["first_token"], settings["percentile"])
+                if backend["first_token"] else None,
+                "deadline": backend["deadline"],
+                "read_timeout": backend["read_timeout"],
+                "stretch": backend["stretch"]
+            }
+            for key, backend in backends.items()
+        }
+
+
+def to_json():
+    with backends_lock:
+        return {
+            key: {
+                "first_token": list(backend["first_token"]),
+                "seconds_per_token": list(backend["seconds_per_token"]),
+                "completion_tokens": list(backend["completion_tokens"]),
+                "prompt_tokens": list(backend["prompt_tokens"]),
+                "stretch": backend["stretch"],
+                "deadline": backend["deadline"],
+                "read_timeout": backend["read_timeout"]
+            }
+            for key, backend in backends.items()
+        }
+
+
+def load(data):
+    with backends_lock:
+        for key, saved in (data or {}).items():
+            if key in backends:
+                continue
+            backend = get_backend(key)
+            backend["first_token"].extend(saved.get("first_token", []))
+            backend["seconds_per_token"].extend(saved.get("seconds_per_token", []))
+            backend["completion_tokens"].extend(saved.get("completion_tokens", []))
+            backend["prompt_tokens"].extend(saved.get("prompt_tokens", []))
+            backend["stretch"] = saved.get("stretch", 1.0)
+            backend["deadline"] = saved.get("deadline")
+            backend["read_timeout"] = saved.get("read_timeout")
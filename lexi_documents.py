@@ -0,0 +1,162 @@
+import codecs
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+
+import lexi_http
+
+READ_BLOCK_SIZE = 64 * 1024
+TEXT_MIME_TYPES = ("application/json", "application/xml", "application/x-yaml", "application/javascript",
+                   "application/x-sh", "application/sql", "application/csv")
+TEXT_EXTENSIONS = (".txt", ".md", ".rst", ".csv", ".tsv", ".json", ".jsonl", ".xml", ".yaml", ".yml", ".ini",
+                   ".toml", ".cfg", ".log", ".py", ".js", ".ts", ".java", ".c", ".h", ".cpp", ".go", ".rs", ".sh",
+                   ".sql", ".html", ".css")
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class DocumentTooLarge(Exception):
+    pass
+
+
+def is_text_document(file_name, mime_type):
+    if mime_type and (mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES):
+        return True
+    return bool(file_name) and file_name.lower().endswith(TEXT_EXTENSIONS)
+
+
+def download(url, max_bytes, api_request_timeout=120):
+    # Streams to a temporary file so a large upload never sits in memory whole,
+    # and stops as soon as the size cap is exceeded.
+    response = lexi_http.session.get(url, stream=True, timeout=lexi_http.get_timeout(api_request_timeout))
+    with response:
+        response.raise_for_status()
+        size = 0
+        f = tempfile.NamedTemporaryFile(prefix="lexi-document-", delete=False)
+        try:
+            with f:
+                for block in response.iter_content(READ_BLOCK_SIZE):
+                    size += len(block)
+                    if size > max_bytes:
+                        raise DocumentTooLarge(f"File is larger than {max_bytes} bytes.")
+                    f.write(block)
+        except BaseException:
+            os.remove(f.name)
+            raise
+    return f.name, size
+
+
+def iter_text(path, block_size=READ_BLOCK_SIZE):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def split_tokens(blocks, encoding, chunk_tokens):
+    # Encodes block by block and carries the incomplete last chunk over to the
+    # next block, so every chunk but the last has exactly chunk_tokens tokens.
+    carry = []
+    for text in blocks:
+        tokens = carry + encoding.encode_ordinary(text)
+        full = len(tokens) - len(tokens) % chunk_tokens
+        for start in range(0, full, chunk_tokens):
+            yield encoding.decode(tokens[start:start + chunk_tokens]), chunk_tokens
+        carry = tokens[full:]
+    if carry:
+        yield encoding.decode(carry), len(carry)
+
+
+def tokenize_words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+class DocumentStore:
+    # Keeps the chunks of recently uploaded documents per context, within a
+    # per-chat byte budget shared by all of the chat's thread contexts; the
+    # oldest documents are dropped first.
+
+    def __init__(self, max_bytes_per_chat):
+        self.max_bytes_per_chat = max_bytes_per_chat
+        self.documents = {}
+        # Upload order and size of every document of a chat, keyed by (context key, name).
+        self.chats = {}
+        self.key_chats = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, chat_id, name, chunks):
+        size = sum(len(text.encode("utf-8")) for text, _ in chunks)
+        with self.lock:
+            documents = self.documents.setdefault(key, OrderedDict())
+            documents.pop(name, None)
+            documents[name] = {"chunks": chunks, "size": size}
+            uploads = self.chats.setdefault(chat_id, OrderedDict())
+            uploads.pop((key, name), None)
+            uploads[(key, name)] = size
+            self.key_chats[key] = chat_id
+            while len(uploads) > 1 and sum(uploads.values()) > self.max_bytes_per_chat:
+                (evicted_key, evicted), _ = uploads.popitem(last=False)
+                self.documents[evicted_key].pop(evicted, None)
+                if not self.documents[evicted_key]:
+                    self.forget_locked(evicted_key)
+                logging.info("Dropped document %s from context %s to stay within the size cap.", evicted, evicted_key)
+
+    def has_documents(self, key):
+        return bool(self.documents.get(key))
+
+    def select_excerpts(self, key, query, max_tokens):
+        with self.lock:
+            documents = list((self.documents.get(key) or {}).items())
+        chunks = [(name, index, text, tokens) for name, document in documents
+                  for index, (text, tokens) in enumerate(document["chunks"])]
+        if not chunks:
+            return []
+
+        # BM25-style lexical ranking: the question's words, weighted by how
+        # rare they are across the chunks.
+        query_words = set(tokenize_words(query or ""))
+        chunk_words = [Counter(word for word in tokenize_words(text) if word in query_words)
+                       for _, _, text, _ in chunks]
+        document_frequency = Counter(word for words in chunk_words for word in words)
+        scores = []
+        for position, words in enumerate(chunk_words):
+            score = sum(math.log(1 + len(chunks) / document_frequency[word]) * count / (count + 1.2)
+                        for word, count in words.items())
+            scores.append((score, -position))
+
+        selected = []
+        used_tokens = 0
+        for score, negative_position in sorted(scores, reverse=True):
+            name, index, text, tokens = chunks[-negative_position]
+            if used_tokens + tokens > max_tokens:
+                continue
+            selected.append(-negative_position)
+            used_tokens += tokens
+        # Keep the selected excerpts in document order so they read naturally.
+        return [(chunks[position][0], chunks[position][2]) for position in sorted(selected)]
+
+    def forget(self, key):
+        with self.lock:
+            self.forget_locked(key)
+
+    def forget_locked(self, key):
+        self.documents.pop(key, None)
+        chat_id = self.key_chats.pop(key, None)
+        uploads = self.chats.get(chat_id)
+        if uploads is None:
+            return
+        for upload in [upload for upload in uploads if upload[0] == key]:
+            del uploads[upload]
+        if not uploads:
+            del self.chats[chat_id]
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+import zlib
+from array import array
+
+ROLES = ("system", "user", "assistant")
+ROLE_IDS = {role: index for index, role in enumerate(ROLES)}
+
+
+class ChatHistory:
+    # Turns are stored column-wise: one byte per role and a flat list of contents.
+    # The system prompt is not stored here at all; it is passed in when the
+    # message list is built, so changing it does not touch every chat.
+    # Token counts are cached per turn (-1 until counted) for one tokenizer
+    # encoding, alongside the server-reported prompt size of the last request,
+    # the model that reported it and the local estimate it corresponded to, so
+    # only turns added since then need tokenizing.
+    __slots__ = ("roles", "contents", "compressed", "compressed_roles", "last_used", "lock",
+                 "token_counts", "token_encoding", "prompt_model", "server_prompt_tokens", "local_prompt_tokens")
+
+    def __init__(self):
+        self.roles = bytearray()
+        self.contents = []
+        self.compressed = None
+        self.compressed_roles = bytearray()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        self.token_counts = array("i")
+        self.token_encoding = None
+        self.prompt_model = None
+        self.server_prompt_tokens = None
+        self.local_prompt_tokens = None
+
+    def __len__(self):
+        return len(self.compressed_roles) + len(self.roles)
+
+    def append(self, role, content, tokens=-1):
+        with self.lock:
+            self.roles.append(ROLE_IDS[role])
+            self.contents.append(content)
+            self.token_counts.append(tokens)
+            self.last_used = time.monotonic()
+
+    def pop_oldest(self):
+        with self.lock:
+            self.inflate()
+            if not self.roles:
+                return None
+            role = ROLES[self.roles.pop(0)]
+            return {"role": role, "content": self.contents.pop(0), "tokens": self.token_counts.pop(0)}
+
+    def clear(self):
+        with self.lock:
+            self.roles = bytearray()
+            self.contents = []
+            self.compressed = None
+            self.compressed_roles = bytearray()
+            self.token_counts = array("i")
+            self.prompt_model = None
+            self.server_prompt_tokens = None
+            self.local_prompt_tokens = None
+
+    def count_tokens(self, encoding, count_turns):
+        with self.lock:
+            if self.token_encoding != encoding:
+                self.inflate()
+                self.token_counts = array("i", [-1]) * len(self)
+                self.token_encoding = encoding
+            offset = len(self.compressed_roles)
+            if offset and min(self.token_counts[:offset]) < 0:
+                self.inflate()
+                offset = 0
+            # Uncounted turns are counted in one call so they can be encoded as a batch.
+            missing = [index for index in range(len(self.token_counts)) if self.token_counts[index] < 0]
+            if missing:
+                counts = count_turns([(ROLES[self.roles[index - offset]], self.contents[index - offset])
+                                      for index in missing])
+                for index, tokens in zip(missing, counts):
+                    self.token_counts[index] = tokens
+            return sum(self.token_counts)
+
+    def last_content(self):
+        with self.lock:
+            return self.contents[-1] if self.contents else None
+
+    def to_messages(self, system_prompt=None):
+        with self.lock:
+            self.inflate()
+            self.last_used = time.monotonic()
+            messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+            messages.extend({"role": ROLES[role], "content": content} for role, content in zip(self.roles, self.contents))
+            return messages
+
+    def compress(self, keep_recent=4):
+        with self.lock:
+            if self.compressed is not None or len(self.roles) <= keep_recent:
+                return 0
+            count = len(self.roles) - keep_recent
+            self.compressed = zlib.compress(json.dumps(self.contents[:count]).encode("utf-8"))
+            self.compressed_roles = self.roles[:count]
+            del self.roles[:count]
+            del self.contents[:count]
+            return count
+
+    def inflate(self):
+        if self.compressed is None:
+            return
+        self.contents[:0] = json.loads(zlib.decompress(self.compressed).decode("utf-8"))
+        self.roles[:0] = self.compressed_roles
+        self.compressed = None
+        self.compressed_roles = bytearray()
+
+    def is_idle(self, idle_seconds):
+        return time.monotonic() - self.last_used > idle_seconds
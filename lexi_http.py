@@ -0,0 +1,218 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]))
+session = requests.Session()
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+class Deadline:
+    # One absolute deadline shared by every attempt of a request, with separate
+    # connect and read (time between bytes) timeouts. It can be passed wherever
+    # api_request_timeout is taken.
+
+    def __init__(self, seconds=None, connect_timeout=None, read_timeout=None, expires=None):
+        self.expires = expires if expires is not None else (time.monotonic() + seconds if seconds else None)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    @property
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def raise_if_expired(self):
+        if self.expired:
+            raise DeadlineExceeded("Request deadline exceeded.")
+
+
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason=None):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks = list(self.callbacks)
+        logging.info("Cancelling request: %s", reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.debug("Error in cancel callback: %s", e)
+
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise RequestCancelled(self.reason)
+
+
+def preconnect(url, connections=1):
+    # Each concurrent request checks out its own pooled connection, so this
+    # leaves up to `connections` established (and TLS-negotiated) sockets idle
+    # in the pool for the first real requests to reuse.
+    def open_connection():
+        try:
+            session.head(url, timeout=5, allow_redirects=False).close()
+        except requests.exceptions.RequestException as e:
+            logging.debug("Error pre-opening connection to %s: %s", url, e)
+
+    threads = [threading.Thread(target=open_connection, daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def get_timeout(api_request_timeout):
+    if isinstance(api_request_timeout, Deadline):
+        api_request_timeout.raise_if_expired()
+        remaining = api_request_timeout.remaining()
+        connect, read = api_request_timeout.connect_timeout, api_request_timeout.read_timeout
+        if remaining is not None:
+            connect = min(connect, remaining) if connect else remaining
+            read = min(read, remaining) if read else remaining
+        return connect, read
+    return api_request_timeout if api_request_timeout else None
+
+
+def abort_response(response):
+    # Closing the response alone does not wake a thread blocked in recv(),
+    # so shut the socket down first to drop the connection immediately.
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def stream_lines(url, headers=None, data=None, api_request_timeout=120, cancel_token=None):
+    if cancel_token:
+        cancel_token.raise_if_cancelled()
+
+    response = session.post(url, headers=headers, json=data, timeout=get_timeout(api_request_timeout), stream=True)
+
+    def abort():
+        abort_response(response)
+
+    if cancel_token:
+        cancel_token.add_callback(abort)
+    # The read timeout only bounds the gap between bytes; a timer enforces the
+    # deadline on a response that keeps streaming past it.
+    timer = None
+    deadline_hit = threading.Event()
+
+    def expire():
+        deadline_hit.set()
+        abort()
+
+    remaining = api_request_timeout.remaining() if isinstance(api_request_timeout, Deadline) else None
+    if remaining is not None:
+        timer = threading.Timer(max(remaining, 0), expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        response.raise_for_status()
+        # Backends stream UTF-8 but rarely declare a charset, and requests
+        # would otherwise assume ISO-8859-1 for text/event-stream.
+        response.encoding = "utf-8"
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            if line:
+                yield line
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if deadline_hit.is_set():
+            raise DeadlineExceeded("Request deadline exceeded while streaming.")
+    except (RequestCancelled, DeadlineExceeded):
+        raise
+    except Exception as e:
+        if cancel_token and cancel_token.cancelled:
+            raise RequestCancelled(cancel_token.reason) from e
+        if deadline_hit.is_set():
+            raise DeadlineExceeded("Request deadline exceeded while streaming.") from e
+        if isinstance(e, requests.exceptions.ConnectionError) and e.args and isinstance(e.args[0], ReadTimeoutError):
+            # requests reports a read timeout in the middle of a stream as a
+            # connection error.
+            raise requests.exceptions.ReadTimeout(*e.args) from e
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+        if cancel_token:
+            cancel_token.remove_callback(abort)
+        response.close()
+
+
+def json_loads(data):
+    # orjson decodes large responses (model lists, embeddings) several times
+    # faster than the standard library; it is used when installed.
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def iter_json_lines(lines):
+    for line in lines:
+        yield json_loads(line)
+
+
+def iter_sse_data(lines):
+    for line in lines:
+        if not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            break
+        yield json_loads(payload)
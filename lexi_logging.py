@@ -0,0 +1,133 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+DEFAULT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+MESSAGE_LENGTH_FACTOR = 4
+
+listener = None
+secrets = []
+
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    # prepare() runs in the thread that logs: it merges the (truncated) arguments into the
+    # message so the record no longer references caller objects, and leaves
+    # timestamps, JSON encoding and I/O to the listener thread.
+
+    def __init__(self, log_queue, max_length):
+        super().__init__(log_queue)
+        self.max_length = max_length
+
+    def truncate(self, value):
+        if isinstance(value, str) and self.max_length and len(value) > self.max_length:
+            return f"{value[:self.max_length]}... [{len(value) - self.max_length} more characters]"
+        return value
+
+    def prepare(self, record):
+        if record.args:
+            if isinstance(record.args, tuple):
+                record.args = tuple(self.truncate(arg) for arg in record.args)
+            message = record.getMessage()
+        else:
+            message = str(record.msg)
+        for secret in secrets:
+            message = message.replace(secret, "***")
+        # Non-string arguments (dicts, lists, responses) are only cut after formatting.
+        limit = self.max_length * MESSAGE_LENGTH_FACTOR
+        if limit and len(message) > limit:
+            message = f"{message[:limit]}... [{len(message) - limit} more characters]"
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            for secret in secrets:
+                record.exc_text = record.exc_text.replace(secret, "***")
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    # Caps INFO and DEBUG records per call site and second; warnings and errors
+    # always pass. The next record let through reports how many were dropped.
+
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = int(time.monotonic())
+        with self.lock:
+            second, count, suppressed = self.sites.get(key, (now, 0, 0))
+            if second != now:
+                second, count = now, 0
+            if count >= self.per_second:
+                self.sites[key] = (second, count, suppressed + 1)
+                return False
+            self.sites[key] = (second, count + 1, 0)
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def redact(secret):
+    # Masks the secret in every record, including those of libraries such as
+    # urllib3 that log request URLs with a bot token in them.
+    if secret and secret not in secrets:
+        secrets.append(secret)
+
+
+def setup():
+    global listener
+    if listener is not None:
+        return
+
+    level = os.environ.get("LEXI_LOG_LEVEL", "INFO").upper()
+    max_length = int(os.environ.get("LEXI_LOG_MAX_LENGTH", 1000))
+    rate_limit = int(os.environ.get("LEXI_LOG_RATE_LIMIT", 20))
+    log_file = os.environ.get("LEXI_LOG_FILE")
+
+    output = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler()
+    if os.environ.get("LEXI_LOG_FORMAT", "text") == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    handler = TruncatingQueueHandler(log_queue, max_length)
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+
+class VectorIndex:
+    # Rows are L2-normalised float32 vectors in a buffer that grows by doubling,
+    # so adding turns never rebuilds the index and cosine similarity is a single
+    # matrix product. On disk, vectors and texts are append-only files.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dim = None
+        self.vectors = None
+        self.count = 0
+        self.texts = []
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, extra):
+        needed = self.count + extra
+        if needed <= len(self.vectors):
+            return
+        capacity = max(needed, len(self.vectors) * 2, 64)
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:self.count] = self.vectors[:self.count]
+        self.vectors = vectors
+
+    def add(self, vectors, texts):
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            raise ValueError("Expected one vector per text.")
+        with self.lock:
+            if self.dim != vectors.shape[1]:
+                if self.count:
+                    logging.warning("Embedding size changed from %s to %s. Resetting index.",
+                                    self.dim, vectors.shape[1])
+                self.reset(vectors.shape[1])
+            self.reserve(len(vectors))
+            self.vectors[self.count:self.count + len(vectors)] = vectors
+            self.count += len(vectors)
+            self.texts.extend(texts)
+            if self.path:
+                self.append_to_disk(vectors, texts)
+
+    def search(self, queries, top_k=3):
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        with self.lock:
+            if not self.count or queries.shape[1] != self.dim:
+                return [[] for _ in range(len(queries))]
+            scores = queries @ self.vectors[:self.count].T
+            texts = self.texts
+        top_k = min(top_k, scores.shape[1])
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        results = []
+        for row, indices in enumerate(candidates):
+            indices = indices[np.argsort(-scores[row, indices])]
+            results.append([(float(scores[row, index]), texts[index]) for index in indices])
+        return results
+
+    def reset(self, dim):
+        self.dim = dim
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.count = 0
+        self.texts = []
+        if self.path:
+            for suffix in (".f32", ".jsonl"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+            with open(self.path + ".meta", "w", encoding="utf-8") as f:
+                json.dump({"dim": dim}, f)
+
+    def append_to_disk(self, vectors, texts):
+        with open(self.path + ".f32", "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self.path + ".jsonl", "a", encoding="utf-8") as f:
+            for text in texts:
+                f.write(json.dumps(text) + "\n")
+
+    def load(self):
+        try:
+            with open(self.path + ".meta", "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+            with open(self.path + ".jsonl", "r", encoding="utf-8") as f:
+                self.texts = [json.loads(line) for line in f]
+            self.vectors = np.fromfile(self.path + ".f32", dtype=np.float32).reshape(-1, self.dim)
+        except FileNotFoundError:
+            self.dim = None
+            self.texts = []
+            return
+        # A crash between the two appends can leave one file a batch ahead of the other.
+        self.count = min(len(self.vectors), len(self.texts))
+        self.texts = self.texts[:self.count]
+        self.vectors = self.vectors[:self.count].copy()
+
+
+class MemoryStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get_index(self, chat_id):
+        with self.lock:
+            index = self.indexes.get(chat_id)
+            if index is None:
+                os.makedirs(self.directory, exist_ok=True)
+                index = self.indexes[chat_id] = VectorIndex(os.path.join(self.directory, str(chat_id)))
+            return index
+
+    def add(self, chat_id, vectors, texts):
+        self.get_index(chat_id).add(vectors, texts)
+
+    def search(self, chat_id, query, top_k=3, min_score=0.0):
+        results = self.get_index(chat_id).search(query, top_k)[0]
+        return [text for score, text in results if score >= min_score]
+
+    def forget(self, chat_id):
+        with self.lock:
+            self.indexes.pop(chat_id, None)
+        for suffix in (".meta", ".f32", ".jsonl"):
+            path = os.path.join(self.directory, str(chat_id)) + suffix
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
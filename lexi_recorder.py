@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+record_file = None
+record_lock = threading.Lock()
+record_salt = None
+record_started = None
+
+
+def start(path):
+    global record_file, record_salt, record_started
+    if record_file is not None:
+        return
+    record_file = open(path, "a", encoding="utf-8", buffering=1)
+    # A fresh salt per recording keeps ids consistent within a file without
+    # making them linkable to real Telegram ids or to other recordings.
+    record_salt = os.urandom(16)
+    record_started = time.monotonic()
+    write({"type": "start", "wall_time": time.time()})
+    logging.info("Recording traffic to %s", path)
+
+
+def is_recording():
+    return record_file is not None
+
+
+def anonymize(value):
+    return hashlib.sha256(record_salt + str(value).encode("utf-8")).hexdigest()[:16]
+
+
+def write(event):
+    event["t"] = round(time.monotonic() - record_started, 4)
+    line = json.dumps(event)
+    with record_lock:
+        record_file.write(line + "\n")
+
+
+def record_message(message, is_admin=False, mentions_bot=False, replies_to_bot=False):
+    if record_file is None:
+        return
+    text = message.text or message.caption or ""
+    event = {
+        "type": "message",
+        "chat": anonymize(message.chat.id),
+        "chat_type": message.chat.type,
+        "user": anonymize(message.from_user.id) if message.from_user else None,
+        "admin": is_admin,
+        "content_type": message.content_type,
+        "length": len(text),
+        "mention": mentions_bot,
+        "reply_to_bot": replies_to_bot
+    }
+    if text.startswith("/"):
+        event["command"] = text.split()[0].split("@")[0]
+    write(event)
+
+
+def record_backend(api_type, model, latency, response=None, error=None):
+    if record_file is None:
+        return
+    response = response or {}
+    timings = response.get("timings") or {}
+    write({
+        "type": "backend",
+        "api_type": api_type,
+        "model": model,
+        "latency": round(latency, 4),
+        "first_token": timings.get("first_token"),
+        "prompt_tokens": response.get("prompt_tokens"),
+        "completion_tokens": response.get("completion_tokens"),
+        "response_length": len(response.get("text") or ""),
+        "error": type(error).__name__ if error else None
+    })
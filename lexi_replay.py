@@ -0,0 +1,278 @@
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types as pytypes
+
+REPLAY_BOT_TOKEN = "0:replay"
+REPLAY_BOT_USERNAME = "lexireplay"
+REPLAY_BOT_ID = 10
+REPLAY_ADMIN_ID = 1
+DEFAULT_BACKEND_SAMPLE = {"latency": 1.0, "first_token": 0.2, "response_length": 300}
+
+sent_lock = threading.Lock()
+dispatched = {}
+replies = {}
+telegram_calls = {"count": 0}
+
+
+def load_recording(path):
+    messages = []
+    backend_samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            event = json.loads(line)
+            if event["type"] == "message":
+                messages.append(event)
+            elif event["type"] == "backend" and not event.get("error"):
+                backend_samples.append(event)
+    messages.sort(key=lambda event: event["t"])
+    return messages, backend_samples
+
+
+def read_rss():
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class TelegramResponse:
+    def __init__(self, result):
+        self.status_code = 200
+        self.reason = "OK"
+        self.text = json.dumps({"ok": True, "result": result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def make_telegram_sender(latency):
+    message_ids = iter(range(1_000_000, sys.maxsize))
+
+    def sender(method, url, params=None, files=None, timeout=None, proxies=None):
+        name = url.rsplit("/", 1)[-1]
+        params = params or {}
+        if latency:
+            time.sleep(latency)
+        with sent_lock:
+            telegram_calls["count"] += 1
+            message_id = next(message_ids)
+        if name == "getMe":
+            return TelegramResponse({"id": REPLAY_BOT_ID, "is_bot": True, "first_name": "Lexi",
+                                     "username": REPLAY_BOT_USERNAME})
+        if name == "sendMessage":
+            reply_parameters = params.get("reply_parameters")
+            reply_to = json.loads(reply_parameters)["message_id"] if reply_parameters else params.get("reply_to_message_id")
+            key = (int(params["chat_id"]), int(reply_to)) if reply_to else None
+            with sent_lock:
+                if key in dispatched and key not in replies:
+                    replies[key] = time.monotonic() - dispatched[key]
+        if name in ("sendMessage", "sendDocument", "editMessageText"):
+            return TelegramResponse({"message_id": message_id, "date": int(time.time()),
+                                     "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}, "text": ""})
+        return TelegramResponse(True)
+
+    return sender
+
+
+def make_backend_plugin(samples, latency_scale):
+    samples = samples or [DEFAULT_BACKEND_SAMPLE]
+    plugin = pytypes.ModuleType("replay_plugin")
+    plugin.PLUGIN_NAME = "Replay"
+    plugin.default_host = "replay://"
+    plugin.api_key_required = False
+
+    def send_api_request(host, model, api_key, messages, system_prompt=None, api_request_timeout=120,
+                         cancel_token=None, max_tokens=None, context_length=None):
+        from lexi_http import RequestCancelled
+        sample = random.choice(samples)
+        latency = (sample.get("latency") or 0) * latency_scale
+        if cancel_token is not None:
+            if cancel_token.event.wait(latency):
+                raise RequestCancelled(cancel_token.reason)
+        else:
+            time.sleep(latency)
+        first_token = sample.get("first_token")
+        return {
+            "text": "x" * max(sample.get("response_length") or 1, 1),
+            "prompt_tokens": sample.get("prompt_tokens"),
+            "completion_tokens": sample.get("completion_tokens"),
+            "timings": {"first_token": first_token * latency_scale if first_token else None, "total": latency}
+        }
+
+    plugin.send_api_request = send_api_request
+    plugin.is_host_available = lambda host, api_key=None: True
+    plugin.get_available_models = lambda host, api_key=None: ["replay"]
+    plugin.get_model_capabilities = lambda host, model, api_key=None: {"context_length": 8192,
+                                                                         "max_output_tokens": 1024}
+    return plugin
+
+
+class IdMap:
+    def __init__(self, start, step):
+        self.ids = {}
+        self.next_id = start
+        self.step = step
+
+    def get(self, key):
+        if key not in self.ids:
+            self.ids[key] = self.next_id
+            self.next_id += self.step
+        return self.ids[key]
+
+
+def build_update(event, update_id, chats, users):
+    from telebot import types
+
+    chat_type = event.get("chat_type") or "private"
+    if event.get("admin"):
+        user_id = REPLAY_ADMIN_ID
+    else:
+        user_id = users.get(event.get("user"))
+    chat_id = user_id if chat_type == "private" else chats.get(event["chat"])
+
+    if event.get("command"):
+        text = event["command"]
+    else:
+        prefix = f"@{REPLAY_BOT_USERNAME} " if event.get("mention") else ""
+        text = prefix + "lorem ipsum " * max(event.get("length", 0) // 12, 1)
+
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Replay"},
+        "text": text.strip()
+    }
+    if event.get("reply_to_bot"):
+        message["reply_to_message"] = {
+            "message_id": update_id - 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": {"id": REPLAY_BOT_ID, "is_bot": True, "first_name": "Lexi"},
+            "text": "..."
+        }
+    return types.Update.de_json({"update_id": update_id, "message": message}), (chat_id, update_id)
+
+
+def wait_for_drain(lexi, timeout):
+    import lexi_admission
+
+    deadline = time.monotonic() + timeout
+    idle_checks = 0
+    while time.monotonic() < deadline:
+        busy = (lexi.inflight_requests or lexi.pending_turns or lexi_admission.get_stats()["queued"]
+                or lexi.bot.worker_pool.tasks.qsize())
+        idle_checks = 0 if busy else idle_checks + 1
+        if idle_checks >= 5:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded Lexi traffic file against a stubbed backend.")
+    parser.add_argument("recording", help="JSONL file written with LEXI_RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument("--config", help="config.json to replay with (api settings are replaced by the stub)")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="simulated Telegram API latency in seconds")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplier for recorded backend latencies")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="seconds to wait for outstanding requests")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    recording = os.path.abspath(args.recording)
+    messages, backend_samples = load_recording(recording)
+    if not messages:
+        sys.exit("The recording contains no messages.")
+
+    replay_config = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            replay_config = json.load(f)
+    replay_config.update({"api_type": "Replay", "host": "replay://", "model": "replay", "api_key": None,
+                          "allow_all_users": True})
+    replay_config.setdefault("group_mode", "respond_to_mentions_only")
+    replay_config.setdefault("memory", {"enabled": False})
+
+    os.environ.update(BOT_TOKEN=REPLAY_BOT_TOKEN, BOT_USERNAME=REPLAY_BOT_USERNAME, ADMIN_USER_ID=str(REPLAY_ADMIN_ID))
+    os.environ.pop("LEXI_RECORD_FILE", None)
+
+    import telebot.apihelper
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = make_telegram_sender(args.telegram_latency)
+
+    # Plugins are discovered relative to the working directory, so import the
+    # API layer from the repository before moving into a scratch directory.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    import lexi_admission
+    import lexi_ai_api
+    lexi_ai_api.SUPPORTED_API_TYPES["Replay"] = make_backend_plugin(backend_samples, args.latency_scale)
+
+    work_dir = tempfile.mkdtemp(prefix="lexi-replay-")
+    os.chdir(work_dir)
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump(replay_config, f)
+
+    import lexi
+    lexi.start_services()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    chats = IdMap(-1000, -1)
+    users = IdMap(1000, 1)
+    rss_start = read_rss()
+    rss_peak = rss_start
+    started = time.monotonic()
+    first_offset = messages[0]["t"]
+
+    for update_id, event in enumerate(messages, start=1):
+        delay = (event["t"] - first_offset) / args.speed - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+        update, key = build_update(event, update_id * 2, chats, users)
+        with sent_lock:
+            dispatched[key] = time.monotonic()
+        lexi.bot.process_new_updates([update])
+        rss_peak = max(rss_peak, read_rss())
+
+    drained = wait_for_drain(lexi, args.drain_timeout)
+    elapsed = time.monotonic() - started
+    rss_peak = max(rss_peak, read_rss())
+
+    latencies = list(replies.values())
+    admission = lexi_admission.get_stats()
+    dequeued = admission["completed"] + admission["expired"]
+    print(f"Replayed {len(messages)} messages in {elapsed:.1f}s at {args.speed}x "
+          f"({len(messages) / elapsed:.1f} msg/s){'' if drained else ' - did not drain before timeout'}")
+    print(f"Replies: {len(latencies)} ({len(latencies) / elapsed:.2f}/s), Telegram calls: {telegram_calls['count']}")
+    if latencies:
+        print("Reply latency: " + ", ".join(
+            f"p{int(fraction * 100)} {percentile(latencies, fraction) * 1000:.0f} ms" for fraction in (0.5, 0.95, 0.99)
+        ) + f", max {max(latencies) * 1000:.0f} ms")
+    print(f"Admission: admitted {admission['admitted']}, completed {admission['completed']}, "
+          f"shed {admission['shed_queue_full'] + admission['shed_budget'] + admission['shed_deadline']}, "
+          f"expired {admission['expired']}")
+    if dequeued:
+        print(f"Queue delay: mean {admission['wait_total'] / dequeued * 1000:.0f} ms, "
+              f"max {admission['wait_max'] * 1000:.0f} ms")
+    print(f"RSS: start {rss_start / 2 ** 20:.1f} MiB, peak {rss_peak / 2 ** 20:.1f} MiB, "
+          f"growth {(rss_peak - rss_start) / 2 ** 20:.1f} MiB, "
+          f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    print(f"Working directory: {work_dir}")
+
+
+if __name__ == "__main__":
+    main()
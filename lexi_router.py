@@ -0,0 +1,241 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+
+DEFAULT_TARGET = "default"
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "targets": {},
+    "rules": [],
+    "fallback": [],
+    "user_tiers": {},
+    "health_window": 20,
+    "min_samples": 5,
+    "max_error_rate": 0.5,
+    "max_latency": 0,
+    "cooldown_seconds": 60,
+    "metrics_file": None
+}
+
+settings = dict(DEFAULT_SETTINGS)
+health = {}
+health_lock = threading.Lock()
+metrics = {
+    "decisions": Counter(),
+    "fallbacks": Counter(),
+    "requests": Counter(),
+    "latency_total": Counter(),
+    "tokens": Counter(),
+    "cost": Counter()
+}
+
+
+def configure(new_settings=None):
+    global settings
+    settings = dict(DEFAULT_SETTINGS)
+    if new_settings:
+        settings.update(new_settings)
+    if settings["enabled"]:
+        logging.info("Routing enabled with targets %s and %s rules.", list(settings['targets']), len(settings['rules']))
+
+
+def is_enabled():
+    return bool(settings["enabled"] and settings["targets"])
+
+
+def get_user_tier(user_id):
+    return settings["user_tiers"].get(str(user_id), "default")
+
+
+def get_target(name, default_target):
+    if name == DEFAULT_TARGET:
+        return {"name": DEFAULT_TARGET, **default_target}
+    target = settings["targets"].get(name)
+    if target is None:
+        logging.warning("Routing target '%s' is not defined.", name)
+        return None
+    return {"name": name, **target}
+
+
+def get_health(name):
+    entry = health.get(name)
+    if entry is None:
+        entry = health[name] = {
+            "results": deque(maxlen=settings["health_window"]),
+            "latency": None,
+            "down_until": 0
+        }
+    return entry
+
+
+def is_healthy(name, max_latency=None):
+    with health_lock:
+        entry = health.get(name)
+        if entry is None:
+            return True
+        if time.monotonic() < entry["down_until"]:
+            return False
+        max_latency = max_latency or settings["max_latency"]
+        if max_latency and entry["latency"] is not None and entry["latency"] > max_latency:
+            return False
+        return True
+
+
+def rule_matches(rule, message_chars, context_tokens, chat_type, user_tier):
+    if rule.get("max_message_chars") is not None and message_chars > rule["max_message_chars"]:
+        return False
+    if rule.get("min_message_chars") is not None and message_chars < rule["min_message_chars"]:
+        return False
+    if rule.get("max_context_tokens") is not None and context_tokens > rule["max_context_tokens"]:
+        return False
+    if rule.get("min_context_tokens") is not None and context_tokens < rule["min_context_tokens"]:
+        return False
+    if rule.get("chat_types") and chat_type not in rule["chat_types"]:
+        return False
+    if rule.get("user_tiers") and user_tier not in rule["user_tiers"]:
+        return False
+    return True
+
+
+def order_targets(names, prefer):
+    if prefer == "cost":
+        return sorted(names, key=lambda name: settings["targets"].get(name, {}).get("cost_per_1k_tokens", 0))
+    if prefer == "latency":
+        with health_lock:
+            latencies = {name: (health.get(name) or {}).get("latency") for name in names}
+        # Targets without observations yet sort first so they get measured.
+        return sorted(names, key=lambda name: latencies[name] or 0)
+    return list(names)
+
+
+def route(default_target, message_chars=0, context_tokens=0, chat_type=None, user_id=None):
+    # Returns every candidate in the order it should be tried: the first matching
+    # rule's targets, then the global fallback chain, then the configured backend.
+    # Unhealthy targets are moved to the end rather than dropped, so a request is
+    # still attempted when everything is degraded.
+    user_tier = get_user_tier(user_id)
+    rule_name = DEFAULT_TARGET
+    names = []
+    max_latency = None
+    for index, rule in enumerate(settings["rules"]):
+        if rule_matches(rule, message_chars, context_tokens, chat_type, user_tier):
+            rule_name = rule.get("name", f"rule{index}")
+            targets = rule.get("targets") or [rule["target"]]
+            names = order_targets(targets, rule.get("prefer"))
+            max_latency = rule.get("max_latency")
+            break
+
+    candidates = []
+    for name in names + settings["fallback"] + [DEFAULT_TARGET]:
+        if name in (candidate["name"] for candidate in candidates):
+            continue
+        target = get_target(name, default_target)
+        if target is not None:
+            candidates.append(target)
+
+    healthy = [target for target in candidates if is_healthy(target["name"], max_latency)]
+    candidates = healthy + [target for target in candidates if target not in healthy]
+
+    with health_lock:
+        metrics["decisions"][(rule_name, candidates[0]["name"])] += 1
+    logging.info(
+        "Routing request (rule %s, %s chars, %s context tokens, %s, tier %s) to %s",
+        rule_name, message_chars, context_tokens, chat_type, user_tier, [target['name'] for target in candidates]
+    )
+    return candidates
+
+
+def record_result(name, latency, ok, tokens=0):
+    with health_lock:
+        entry = get_health(name)
+        entry["results"].append(ok)
+        metrics["requests"][(name, "ok" if ok else "error")] += 1
+        metrics["latency_total"][name] += latency
+        if ok:
+            entry["latency"] = latency if entry["latency"] is None else entry["latency"] * 0.8 + latency * 0.2
+            if tokens:
+                metrics["tokens"][name] += tokens
+                cost = settings["targets"].get(name, {}).get("cost_per_1k_tokens", 0)
+                metrics["cost"][name] += tokens * cost / 1000
+            return
+
+        results = entry["results"]
+        if len(results) >= settings["min_samples"]:
+            error_rate = results.count(False) / len(results)
+            if error_rate > settings["max_error_rate"]:
+                # Open the circuit for a while, then let traffic probe it again
+                # with a clean window.
+                entry["down_until"] = time.monotonic() + settings["cooldown_seconds"]
+                results.clear()
+                logging.warning(
+                    "Routing target '%s' marked unhealthy (%.0f%% errors) for %ss.",
+                    name, error_rate * 100, settings['cooldown_seconds']
+                )
+
+
+def record_fallback(name):
+    with health_lock:
+        metrics["fallbacks"][name] += 1
+
+
+def get_metrics():
+    with health_lock:
+        now = time.monotonic()
+        targets = {}
+        for name in set(settings["targets"]) | {DEFAULT_TARGET} | set(health):
+            entry = health.get(name) or {}
+            results = entry.get("results") or []
+            targets[name] = {
+                "healthy": now >= entry.get("down_until", 0),
+                "latency": entry.get("latency"),
+                "error_rate": results.count(False) / len(results) if results else None,
+                "ok": metrics["requests"][(name, "ok")],
+                "errors": metrics["requests"][(name, "error")],
+                "fallbacks": metrics["fallbacks"][name],
+                "tokens": metrics["tokens"][name],
+                "cost": metrics["cost"][name]
+            }
+        decisions = dict(metrics["decisions"])
+    return {"targets": targets, "decisions": decisions}
+
+
+def format_metrics():
+    # Prometheus text exposition format, suitable for the node_exporter textfile collector.
+    snapshot = get_metrics()
+    lines = ["# TYPE lexi_router_decisions_total counter"]
+    for (rule, target), count in sorted(snapshot["decisions"].items()):
+        lines.append(f'lexi_router_decisions_total{{rule="{rule}",target="{target}"}} {count}')
+    lines.append("# TYPE lexi_router_requests_total counter")
+    for name, entry in sorted(snapshot["targets"].items()):
+        lines.append(f'lexi_router_requests_total{{target="{name}",outcome="ok"}} {entry["ok"]}')
+        lines.append(f'lexi_router_requests_total{{target="{name}",outcome="error"}} {entry["errors"]}')
+    lines.append("# TYPE lexi_router_fallbacks_total counter")
+    for name, entry in sorted(snapshot["targets"].items()):
+        lines.append(f'lexi_router_fallbacks_total{{target="{name}"}} {entry["fallbacks"]}')
+    lines.append("# TYPE lexi_router_tokens_total counter")
+    for name, entry in sorted(snapshot["targets"].items()):
+        lines.append(f'lexi_router_tokens_total{{target="{name}"}} {entry["tokens"]}')
+    lines.append("# TYPE lexi_router_cost_total counter")
+    for name, entry in sorted(snapshot["targets"].items()):
+        lines.append(f'lexi_router_cost_total{{target="{name}"}} {entry["cost"]:.6f}')
+    lines.append("# TYPE lexi_router_latency_seconds gauge")
+    for name, entry in sorted(snapshot["targets"].items()):
+        if entry["latency"] is not None:
+            lines.append(f'lexi_router_latency_seconds{{target="{name}"}} {entry["latency"]:.3f}')
+    lines.append("# TYPE lexi_router_healthy gauge")
+    for name, entry in sorted(snapshot["targets"].items()):
+        lines.append(f'lexi_router_healthy{{target="{name}"}} {int(entry["healthy"])}')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics():
+    path = settings["metrics_file"]
+    if not path or not is_enabled():
+        return
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(format_metrics())
+    os.replace(temp_path, path)
@@ -0,0 +1,152 @@
+import importlib.util
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import lexi_admission
+import lexi_cpu
+import lexi_deadlines
+import lexi_logging
+import lexi_router
+
+lexi_logging.setup()
+
+LEXI_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexi.py")
+TENANTS_DATA_FILE = "tenants.json"
+DEADLINES_DATA_FILE = os.path.join("tenants", "deadlines.json")
+
+loading_tenant = None
+tenants = {}
+
+
+def from_environment():
+    return {
+        "name": None,
+        "bot_token": os.environ.get("BOT_TOKEN"),
+        "bot_username": os.environ.get("BOT_USERNAME"),
+        "admin_user_id": os.environ.get("ADMIN_USER_ID"),
+        "data_dir": ""
+    }
+
+
+def current():
+    # lexi.py reads its bot settings from here at import time: the tenant being
+    # loaded in multi-tenant mode, or the environment for a single bot.
+    return loading_tenant or from_environment()
+
+
+def load_tenant(tenant):
+    global loading_tenant
+    name = tenant["name"]
+    tenant = {"data_dir": os.path.join("tenants", name), **tenant}
+    os.makedirs(tenant["data_dir"], exist_ok=True)
+
+    # Every tenant gets its own instance of the lexi module, and with it its own
+    # bot, config, allowed users and chat contexts. Modules imported by lexi
+    # (HTTP session, plugins, tokenizers, admission queue) are loaded once and
+    # shared by all tenants.
+    spec = importlib.util.spec_from_file_location(f"lexi_tenant_{name}", LEXI_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    loading_tenant = tenant
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        loading_tenant = None
+
+    lexi_admission.set_tenant_limits(name, tenant.get("max_concurrency", 0), tenant.get("max_queued", 0))
+    tenants[name] = module
+    return module
+
+
+def configure_shared(data):
+    lexi_admission.configure(data.get("admission"))
+    lexi_router.configure(data.get("routing"))
+    lexi_cpu.configure(data.get("cpu_offload"))
+    lexi_deadlines.configure(data.get("deadlines"))
+
+
+def reload(path):
+    # Shared settings come from the tenants file; each tenant then reloads its
+    # own config.json. Tenants added to the file need a restart.
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Not reloading %s: %s", path, e)
+        data = None
+    if data is not None:
+        configure_shared(data)
+    for name, module in tenants.items():
+        logging.info("Tenant %s: %s", name, module.reload())
+
+
+def load_deadlines():
+    try:
+        with open(DEADLINES_DATA_FILE, "r", encoding="utf-8") as f:
+            lexi_deadlines.load(json.load(f))
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        logging.error("Not loading %s: %s", DEADLINES_DATA_FILE, e)
+
+
+def save_deadlines():
+    # Deadlines are learned per backend and shared by all tenants, so they are
+    # saved once for the process rather than into every tenant's directory.
+    if not lexi_deadlines.dirty:
+        return
+    lexi_deadlines.dirty = False
+    os.makedirs(os.path.dirname(DEADLINES_DATA_FILE), exist_ok=True)
+    with open(DEADLINES_DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(lexi_deadlines.to_json(), f, indent=4)
+
+
+def run_maintenance():
+    while True:
+        time.sleep(60)
+        try:
+            save_deadlines()
+        except OSError as e:
+            logging.error("Error saving %s: %s", DEADLINES_DATA_FILE, e)
+
+
+def run_tenant(name, module):
+    logging.info("Tenant %s started and listening for messages.", name)
+    module.bot.polling(none_stop=True)
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("LEXI_TENANTS_FILE", TENANTS_DATA_FILE)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    configure_shared(data)
+    load_deadlines()
+    threading.Thread(target=run_maintenance, name="lexi-tenants-maintenance", daemon=True).start()
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reload, args=(path,), name="lexi-reload", daemon=True).start())
+
+    threads = []
+    for tenant in data["tenants"]:
+        module = load_tenant(tenant)
+        module.start_services()
+        thread = threading.Thread(target=run_tenant, args=(tenant["name"], module),
+                                  name=f"lexi-tenant-{tenant['name']}", daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    logging.info("Serving %s tenants.", len(threads))
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    # lexi.py imports lexi_tenants by name, so run through that module rather
+    # than __main__ to share loading_tenant with it.
+    import lexi_tenants
+    lexi_tenants.main()
@@ -0,0 +1,175 @@
+import cProfile
+import io
+import itertools
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+TRACE_BUFFER_SIZE = 200
+SAMPLE_INTERVAL = 0.005
+
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+trace_ids = itertools.count(1)
+local = threading.local()
+
+profile_lock = threading.Lock()
+profile_stats = None
+profile_until = 0
+
+
+def start_trace(name, **attributes):
+    return {
+        "id": next(trace_ids),
+        "name": name,
+        "attributes": attributes,
+        "started": time.time(),
+        "start": time.perf_counter(),
+        "spans": [],
+        "total": None
+    }
+
+
+def current_trace():
+    return getattr(local, "trace", None)
+
+
+@contextmanager
+def activate(trace):
+    previous = current_trace()
+    local.trace = trace
+    try:
+        yield trace
+    finally:
+        local.trace = previous
+
+
+@contextmanager
+def span(name):
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace["spans"].append((name, started - trace["start"], time.perf_counter() - started))
+
+
+def add_span(name, duration, trace=None, offset=None):
+    trace = trace or current_trace()
+    if trace is None or duration is None:
+        return
+    if offset is None:
+        offset = time.perf_counter() - trace["start"] - duration
+    trace["spans"].append((name, offset, duration))
+
+
+def annotate(**attributes):
+    trace = current_trace()
+    if trace is not None:
+        trace["attributes"].update(attributes)
+
+
+def finish_trace(trace, **attributes):
+    trace["attributes"].update(attributes)
+    trace["total"] = time.perf_counter() - trace["start"]
+    recent_traces.append(trace)
+    logging.debug("Trace %s finished in %.3fs: %s", trace['id'], trace['total'], trace['spans'])
+
+
+def slowest_traces(limit=10, tenant=None):
+    traces = [trace for trace in list(recent_traces) if trace["attributes"].get("tenant") == tenant]
+    return sorted(traces, key=lambda trace: trace["total"], reverse=True)[:limit]
+
+
+def format_trace(trace):
+    attributes = ", ".join(f"{key}={value}" for key, value in trace["attributes"].items() if value is not None)
+    lines = [f"#{trace['id']} {trace['name']} {trace['total'] * 1000:.0f} ms ({attributes})"]
+    for name, offset, duration in trace["spans"]:
+        lines.append(f"  +{offset * 1000:6.0f} ms  {name}: {duration * 1000:.0f} ms")
+    return "\n".join(lines)
+
+
+def run(function, *args, **kwargs):
+    # While a /perf cprofile window is open, every traced job runs under its own
+    # profiler and the results are merged; otherwise the call is untouched.
+    if time.monotonic() >= profile_until:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows only one active profiler, so overlapping jobs run unprofiled.
+        return function(*args, **kwargs)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        with profile_lock:
+            if profile_stats is not None:
+                profile_stats.append(profiler)
+
+
+def profile_jobs(seconds):
+    global profile_stats, profile_until
+    with profile_lock:
+        profile_stats = []
+        profile_until = time.monotonic() + seconds
+    time.sleep(seconds)
+    with profile_lock:
+        profilers, profile_stats = profile_stats, None
+    if not profilers:
+        return f"No requests were handled during the {seconds}s profiling window.\n"
+    output = io.StringIO()
+    stats = pstats.Stats(profilers[0], stream=output)
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    output.write(f"{len(profilers)} requests profiled over {seconds}s\n\n")
+    stats.sort_stats("cumulative").print_stats(60)
+    return output.getvalue()
+
+
+def sample_threads(seconds, interval=SAMPLE_INTERVAL):
+    own_thread = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    inclusive = Counter()
+    exclusive = Counter()
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_firstlineno}({code.co_name})")
+                frame = frame.f_back
+            if not stack:
+                continue
+            exclusive[stack[0]] += 1
+            for location in set(stack):
+                inclusive[location] += 1
+            thread_name = thread_names.get(thread_id, str(thread_id))
+            stacks[";".join([thread_name] + stack[::-1])] += 1
+        samples += 1
+        time.sleep(interval)
+
+    output = io.StringIO()
+    output.write(f"{samples} samples over {seconds}s across all threads\n\n")
+    output.write("Top functions by inclusive samples:\n")
+    for location, count in inclusive.most_common(40):
+        output.write(f"{count:8d}  {location}\n")
+    output.write("\nTop functions by exclusive samples:\n")
+    for location, count in exclusive.most_common(40):
+        output.write(f"{count:8d}  {location}\n")
+    output.write("\nCollapsed stacks (flamegraph.pl input):\n")
+    for stack, count in stacks.most_common():
+        output.write(f"{stack} {count}\n")
+    return output.getvalue()